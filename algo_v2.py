@@ -1,108 +1,204 @@
 import mysql.connector as mc
-import requests
 from datetime import datetime, timedelta
-import random
-
-
-
-def find_schedule(MYSQL_HOST,MYSQL_USER,MYSQL_PASSWORD,MYSQL_DB):
+import os
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from travel_cache import TravelTimeCache, normalize_address
+from distance_matrix import fetch_blocks, plan_requests, new_matrix, place_block, matrix_memory, INF
+from routing import nearest_neighbour_day, improve_route, route_times, held_karp, route_drive, solve_therapist, fill_route
+from vrp import Route, ClinicSolver, solve_part, cheapest_insertion
+from assignment import min_cost_assignment, week_capacity
+from shards import Shards, to_plane
+from spatial import nearest_pairs
+from sparse_matrix import SparseMatrix
+from publish import publish_tables, rollback_tables, diff_tables
+import appointments
+from distance_provider import make_provider
+from geocode import GeocodeCache, GoogleGeocoder, locate, estimate_matrix
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+# The text of a day in patient_schedule from the 'THER_1-32400.0' entries of p_therpay_plan, the seconds are written as a time
+def visit_text(t_id_plus_time: str):
+    temp = t_id_plus_time.split(',')
+    for ele in temp:
+        t = ele.split('-')
+
+        if t[0] != '':
+            formated_time = str(timedelta(seconds=float(t[1])))
+            t[1] = formated_time
+            temp[temp.index(ele)] = '-'.join(t)
+    temp = ','.join(temp)
+    return temp[:len(temp)-1]
+
+
+# 'Mo, We' -> ['Mo', 'We'] (the days and professions are kept as comma separated text), None (no row joined) is []
+def split_list(text):
+    if text is None:
+        return []
+    return list(map(str.strip, text.split(',')))
+
+
+# cache is where the travel times are kept between runs (see travel_cache.py), by default it is a file next to this script
+# provider is where the travel times come from, it can be a DistanceProvider or the configuration for make_provider (see distance_provider.py),
+# by default it is the google api
+# fetch_workers is the number of api calls that can be waiting at the same time and requests_per_second is the limit of calls started in one second
+# travel_times is 'exact', 'estimate' or 'refine' (see below where the matrix is made), the estimates need the position of every address
+# which comes from geocoder (google geocoding api by default) and is kept in geocode_cache
+# solver is 'clinic' or 'greedy' (see plan_clinic and plan_routes), assign_choices > 0 turns on the assignment stage (see assign_patients)
+# workers is the number of processes the therapists (greedy solver) or the shards (clinic solver) are solved in, so with the clinic
+# solver it only does something when shard_size > 0. improve_seconds and lns_seconds are counted in steps of work, not on the clock
+# (see improve_route and ClinicSolver.search), so the schedule is the same however loaded the machine is and for any workers > 1
+# (workers=1 with the greedy solver routes the therapists one after the other, see plan_routes, which can give other routes)
+# changes is a ChangeSet (see changes.py) of what was edited since the last run, then only the affected days are made again (see reschedule),
+# or if patients were only cancelled or added they are just taken out of or put into the stored days (see repair)
+# publish is how a whole new schedule is written, 'diff' (only the rows that changed), 'swap' (shadow tables swapped in at once, the old
+# ones are kept for rollback_schedule) or 'replace' (see the upload at the end)
+# shard_size > 0 cuts the clinic into shards of about that many patients by where they live (see the sharding stage)
+def find_schedule(MYSQL_HOST,MYSQL_USER,MYSQL_PASSWORD,MYSQL_DB,cache=None,provider=None,fetch_workers=8,requests_per_second=10,
+                  travel_times='exact',geocoder=None,geocode_cache=None,refine_rounds=5,improve_seconds=0.05,exact_size=10,
+                  solver='clinic',lns_seconds=1.0,assign_choices=0,workers=1,shard_size=0,
+                  nearest_k=8,changes=None,publish='diff'):
 
     db = mc.connect(host=MYSQL_HOST, user=MYSQL_USER,
                 password=MYSQL_PASSWORD, database=MYSQL_DB)
     curs = db.cursor() 
+    appointments.create_appointments(db)
 
-    # Google distance matrix api
-    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-    KEY = ""                   # API Key
+    # Only the caches (and the provider) made here are closed at the end, the ones given by the caller stay open for the next run
+    own_cache = cache is None
+    if own_cache:
+        cache = TravelTimeCache(os.path.join(SCRIPT_DIRECTORY, "travel_cache.db"))
+    own_geocode_cache = geocode_cache is None
+
+    own_provider = provider is None or isinstance(provider, (str, dict))
+    if own_provider:
+        provider = make_provider(provider)
 
     # The following dictionaries are going to hold the data taken from mysql database
     patient_details = {}
     therapists_details = {}
-    job_id_det = {}
 
     # This dictionary will be used later to get the finalt schedule of each therapist
     therapists_patients_pair = {}
 
 
     # This function gets the data from the databse and stores it in the above dictionaries
+    # everything is read in one transaction WITH CONSISTENT SNAPSHOT, so the patients, their plans and the therapists are all from the
+    # same moment even if the gui saves something while this runs. Only the columns that are used are asked for, the plans and the
+    # availability come joined to their patient or therapist, and the rows are taken from the cursor as they arrive (the default
+    # cursor of mysql.connector is unbuffered) instead of a list of the whole table first
     def read_db():
-        # curs.execute("SELECT * FROM patients JOIN therapy_plans ON patients.ID = therapy_plans.ID ORDER BY patients.ID")
-        # print(curs.fetchall())
-        curs.execute("SELECT * FROM patients")
-        patients_raw = curs.fetchall()
-
-        for row in patients_raw:
-            patient_details[row[0]] = {"name": row[1], "address": row[2], "availability": list(
-                map(str.strip, row[3].split(','))), "reqd_prf": []}
-
-        curs.execute("SELECT * FROM therapy_plans")
-        therapy_plans = curs.fetchall()
-
-        for row in therapy_plans:
-            patient_details[row[0]]['reqd_prf'] = list(
-                map(str.strip, row[1].split(',')))
-
-        curs.execute("SELECT * FROM job_ids")
-        job_ids = curs.fetchall()
-
-        for row in job_ids:
-            job_id_det[row[0]] = row[1]
-
-        curs.execute("SELECT * FROM therapists")
-        therapists_raw = curs.fetchall()
-
-        curs.execute("SELECT * FROM therapist_availability")
-        therapist_availability = curs.fetchall()
-
-        for row in therapists_raw:
-            therapists_details[row[0]] = {
-                "name": row[1], "address": row[2], "job_id": row[3], 'availability': {}}
-
-        for row in therapist_availability:
-            therapists_details[row[0]]['availability'].update(
-                {'time_from': row[3], 'time_to': row[4], 'days': list(map(str.strip, row[2].split(',')))})
-
-
-    # This function is used to get the distance between origins and destination
-    # When multiple origins and/or destinations is given the api gives back a matrix of the distances
-    def get_distance(origin: str, dest: str):
-
-        params = {
-            "origins": origin,
-            "destinations": dest,
-            "units": "imperial",
-            "key": KEY
-        }
-
-        response = requests.request("GET", url, params=params)
-        matrix = []
-        for row in response.json()['rows']:
-            n_row = []
-            for col in row['elements']:
-                n_row.append(col['duration']['value'])
-            matrix.append(n_row)
-        return matrix
-
-
-    # This was just a function to produce a matrix like the one produced by google api, so that
-    # i can use this funciton while testing, and it does not waste the api resources
-    def make_matrix(param: str, param1: str, val,rand=False):
-        num = len(param.split('|'))-1
-        num1 = len(param1.split('|'))-1
-        l = []
-        for r in range(num):
-            row = []
-            for c in range(num1):
-                if rand:
-                    row.append(random.randint(200, 2000))
-                else:
-                    row.append(val)
-            l.append(row)
-        return l
+        curs.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+
+        curs.execute("""SELECT p.ID, p.Patient, p.Patient_Adress, p.Patient_Availability, tp.Required_Profession
+                        FROM patients p LEFT JOIN therapy_plans tp ON tp.ID = p.ID ORDER BY p.ID""")
+        for p_id, name, address, availability, reqd_prf in curs:
+            patient_details[p_id] = {"name": name, "address": address, "availability": split_list(availability),
+                                     "reqd_prf": split_list(reqd_prf)}
+
+        curs.execute("""SELECT t.ID, t.Therapist, t.Therapist_Address, t.Profession, a.Days, a.Time_From, a.Time_To
+                        FROM therapists t LEFT JOIN therapist_availability a ON a.ID = t.ID ORDER BY t.ID""")
+        # a therapist without an availability row can not be given any day, so they are left out of the schedule
+        for t_id, name, address, job_id, days, time_from, time_to in curs:
+            if days is None:
+                print(f"{t_id} has no availability, left out of the schedule")
+                continue
+            therapists_details[t_id] = {"name": name, "address": address, "job_id": job_id,
+                                        'availability': {'time_from': time_from, 'time_to': time_to, 'days': split_list(days)}}
+
+        db.commit()
 
 
     read_db()
 
+
+    # The positions of the addresses (see geocode.py), used by the assignment stage and by travel_times 'estimate' and 'refine'
+    def positions(addrs: list):
+        nonlocal geocode_cache, geocoder
+        if geocode_cache is None:
+            geocode_cache = GeocodeCache(os.path.join(SCRIPT_DIRECTORY, "geocode_cache.db"))
+        if geocoder is None:
+            geocoder = GoogleGeocoder(key=os.environ.get('DISTANCE_API_KEY', ''))
+        return locate(addrs, geocode_cache, geocoder, workers=fetch_workers, per_second=requests_per_second)
+
+
+    t_ids = list(therapists_details)
+    p_ids = list(patient_details)
+    coords = None
+    if assign_choices > 0 or shard_size > 0:
+        coords = positions([therapists_details[t_id]['address'] for t_id in t_ids]+[patient_details[p_id]['address'] for p_id in p_ids])
+
+
+    # The sharding stage: for a big region the clinic is cut into shards by where the patients live (see shards.py) and a patient
+    # is only paired with the therapists of their own shard, or of a shard next to them if they live at its border. If their shard
+    # has no therapist of a profession they need, the therapists of the nearest shard that has one are used
+    # So every therapist's list, and the travel times that are asked for, only grows with the size of the shard and not of the clinic
+    # Gives back the set of (patient id, therapist id) pairs that are kept
+    def shard_pairs():
+        by_shard = {}
+        for t, t_id in enumerate(t_ids):
+            by_shard.setdefault((int(shards.therapist_shard[t]), therapists_details[t_id]['job_id']), []).append(t_id)
+
+        pairs = set()
+        for p, p_id in enumerate(p_ids):
+            for job in dict.fromkeys(patient_details[p_id]['reqd_prf']):
+                near = [t_id for s in shards.near[p] for t_id in by_shard.get((s, job), [])]
+                if not near:
+                    for s in shards.order[p]:
+                        near = by_shard.get((s, job), [])
+                        if near:
+                            break
+                pairs.update((p_id, t_id) for t_id in near)
+        return pairs
+
+    shards = None
+    sharded = None
+    if shard_size > 0:
+        shards = Shards(coords[:len(t_ids)], coords[len(t_ids):], shard_size)
+        print(shards.summary())
+        sharded = shard_pairs()
+
+
+    # The assignment stage: without it a patient goes into the list of every therapist of a profession they need, so every
+    # therapist's matrix and routes carry patients they are never going to visit
+    # Here every need (a patient and one profession they need) is given to at most assign_choices therapists of that profession,
+    # the ones that are the nearest overall (min cost flow, see assignment.py) with the guessed travel times from the geocoded addresses,
+    # while no therapist gets more than the visits that fit in their week. A need that does not fit anywhere goes to the nearest therapist
+    # With shards only the pairs of the sharding stage can be chosen
+    # Gives back the set of (patient id, therapist id) pairs that are kept
+    def assign_patients():
+        est = estimate_matrix(coords[len(t_ids):], dests=coords[:len(t_ids)])
+
+        needs = [(p, job) for p, p_id in enumerate(p_ids) for job in dict.fromkeys(patient_details[p_id]['reqd_prf'])]
+        cost = np.full((len(needs), len(t_ids)), np.inf)
+        for n, (p, job) in enumerate(needs):
+            for t, t_id in enumerate(t_ids):
+                t_det = therapists_details[t_id]
+                if sharded is not None and (p_ids[p], t_id) not in sharded:
+                    continue
+                if t_det['job_id'] == job and set(patient_details[p_ids[p]]['availability']) & set(t_det['availability']['days']):
+                    cost[n, t] = est[p, t]
+
+        capacity = []
+        for t, t_id in enumerate(t_ids):
+            availability = therapists_details[t_id]['availability']
+            time_diff = (datetime.strptime(availability['time_to'], "%H:%M")-datetime.strptime(availability['time_from'], "%H:%M")).total_seconds()
+            reachable = cost[:, t][np.isfinite(cost[:, t])]
+            capacity.append(week_capacity(len(availability['days']), time_diff, float(np.median(reachable)) if len(reachable) else 0))
+
+        used = min_cost_assignment(cost, capacity, assign_choices)
+        for n in range(len(needs)):
+            if not used[n].any() and np.isfinite(cost[n]).any():
+                used[n, cost[n].argmin()] = True
+
+        print(f"assignment kept {int(used.sum())} of {int(np.isfinite(cost).sum())} patient-therapist pairs")
+        return set((p_ids[needs[n][0]], t_ids[t]) for n, t in zip(*np.nonzero(used)))
+
+    allowed = assign_patients() if assign_choices > 0 else sharded
+
     # Here the therapists_patients_pair dictionary is used
     # In this following process, a list of patients taken from the therapy_plans table are mapped to the
     # Corresponding therapists and days and a list of patients for the next week is created and added to the dictionary with
@@ -112,7 +208,7 @@ def find_schedule(MYSQL_HOST,MYSQL_USER,MYSQL_PASSWORD,MYSQL_DB):
         found = 0
         for t_id, t_det in therapists_details.items():
             # print(t_det)
-            if (t_det['job_id'] in p_det['reqd_prf']):
+            if (t_det['job_id'] in p_det['reqd_prf']) and (allowed is None or (p_id, t_id) in allowed):
                 if t_id not in therapists_patients_pair:
                     therapists_patients_pair[t_id] = {'patients': [], 'days': [
                         {day: []} for day in t_det['availability']['days']]}
@@ -129,249 +225,741 @@ def find_schedule(MYSQL_HOST,MYSQL_USER,MYSQL_PASSWORD,MYSQL_DB):
 
 
     # This is the final process that makes the final schedule
-    therapy_plan = {}
-    p_therpay_plan = {}
-    api_limit = 10  # This is the maximum number of origin or destination the api can take in one api call
-    # For example: the api can only take 10 origin and 10 destinations at once which produces a matrix of 10x10 which will have 100 elements in the matrix, which is the limit of the api
+    api_limit = provider.max_side  # This is the maximum number of origin or destination the api can take in one api call
+    api_element_limit = provider.max_elements  # This is the maximum number of elements (origins x destinations) in one api call
+    # For example: the api can take 10 origin and 10 destinations at once which produces a matrix of 10x10 which will have 100 elements in the matrix,
+    # but it can also take 4 origins and 25 destinations, which is also 100 elements
 
     unique_profession_limit = 2
     paitient_week_visit_limit = 3
 
-    for t_id, det in therapists_patients_pair.items():
-        
-        google_params = []
-        pids: list = therapists_patients_pair[t_id]['patients']
-
-        # pids, has the list of patients for the whole week, first we need to find the distances between each patient and therapist
-        # Let's consider the pids has 17 patients
-        # As said earlier the api can take only ten origin and destination per call
-        # So, we need to get the final matrix of 17 x 17 by dividing the pids list into 10+7 elements
-        # Then first the matrix for first 10 matrix is obtained and then the rest 7 elements is obtained
-        # But right now only the parameters are created for api and the it is not yet called.
-
-        pids.insert(0, 't-'+t_id)
-        u_lim = 0
-        num = (len(pids)//10) + (1 if len(pids) % 10 != 0 else 0)
-        l_lim = api_limit if len(pids) > api_limit else len(pids)
-        param = ''
-
-        for _ in range(num):
-            
-            for pid in pids[u_lim:l_lim]:
-                if 't-' in pid:
-                    addr = therapists_details[pid.split('-')[-1]]['address']
-                else:
-                    addr = patient_details[pid]['address']
-                param += addr+"|"
-            u_lim = l_lim
-            l_lim = (l_lim+api_limit) if len(pids)-l_lim > api_limit else len(pids)
-            google_params.append(param)
-            param = ''
-
-        # this is used to make a empty matrix of size len(pids) x len(pids) filled with zeroes
-        
-        mat = make_matrix('a|'*(len(pids)), 'a|'*(len(pids)), 0)
+    # The addresses of every therapist and patient in this run are collected once, so that there is
+    # only one distance matrix for the whole clinic
+    # If the same address is used more than once (a patient who needs three professions is in the list of three therapists,
+    # or two patients live in the same house) it gets only one place in the matrix, so the api is never asked for it twice
+    addresses = []
+    addr_index = {}     # normalized address -> place in the global matrix
+    node_index = {}     # 't-THER_1' or 'PNT_1' -> place in the global matrix
 
-        # This whole process is actually calling the api and
-        # It is a way to add up all the separate matrices into one final matrix
-        # ie. if len(pids) was 17 then first a 10x10 matrix was created by the api call, then 7 x 7 matrix will be created and
-        # then a 7 x 10 and  10 x 7 and 7 x 7 matrices will be created and all these matriced will  be added together to form 17 x 17 matrix
-
-        # Instead of doing the above process we could just take one origin and one destination at once, then the code will be much simpler, but it has a few problems
-        # 1. If the len(pids) was 17 then we have to make api calls that is equal to 17 x 17= 289 api calls, which is a huge number of api calls when compared to the above process
+    for t_id, det in therapists_patients_pair.items():
+        det['patients'].insert(0, 't-'+t_id)
+        for pid in det['patients']:
+            if pid in node_index:
+                continue
+            if 't-' in pid:
+                addr = therapists_details[pid.split('-')[-1]]['address']
+            else:
+                addr = patient_details[pid]['address']
+            key = normalize_address(addr)
+            if key not in addr_index:
+                addr_index[key] = len(addresses)
+                addresses.append(addr)
+            node_index[pid] = addr_index[key]
+
+
+    # This function gets the exact travel times of the given pairs of addresses (indexes into addresses) and puts them into mat
+    # The travel time between two addresses is taken as the same in both directions, so only the pairs (i, j) with j < i are needed
+    # and the value is put at mat[i, j] and mat[j, i]
+    def fill_exact(mat, needed: list):
+
+        # First everything that is already in the cache is put in the matrix, a pair is only missing if neither (a, b) nor (b, a) is in the cache
+        pairs = {(addresses[i], addresses[j]): (i, j) for i, j in needed}
+        found = cache.get_many(pairs)
+        reverse = cache.get_many([(dest, origin) for origin, dest in pairs if (origin, dest) not in found])
+        for (dest, origin), seconds in reverse.items():
+            found[(origin, dest)] = seconds
+
+        known = set(pairs[pair] for pair in found)
+        if found:
+            rows, cols = np.array([pairs[pair] for pair in found]).T
+            seconds = np.fromiter(found.values(), dtype=np.int32, count=len(found))
+            mat[rows, cols] = seconds
+            mat[cols, rows] = seconds
+
+        # Instead of getting the rest of the matrix in some other way we could just take one origin and one destination at once, then the code
+        # will be much simpler, but it has a few problems
+        # 1. If the len(addresses) was 17 then we have to make api calls that is equal to 17 x 17= 289 api calls, which is a huge number of api calls
         # 2. I actually tried this and  it takes much much longer because eaach api call atleast 1 second to return some value, hence almost 289 seconds will be spent on making the distance matrix
 
-        # So here the first method is used to make the distance matrix
-        row, col, offset_r, offset_c = 0, 0, 0, 0
-        lim = 0
-        diff = 3
-        mat_count = 0
-        i = 0
-        while i < len(google_params):
-            main = google_params[i]
-            s_i =0
-            while s_i< i+1:
-                sub_mat = get_distance(main, google_params[s_i])
-                if mat!=lim:
-                    sub_mat_T = [[sub_mat[j][i] for j in range(len(sub_mat))] for i in range(len(sub_mat[0]))]
-                
-                if mat_count==lim:
-                    for r in range(len(sub_mat)):
-                        for c in range(len(sub_mat[0])):
-                            mat[offset_r+r][offset_c+c] = sub_mat[r][c]
-                    old_r = 0
-                    old_c = 0
-
-                    offset_r += len(sub_mat)
-                    offset_c += len(sub_mat)
-
-                    lim+=diff
-                    diff+=2
-                    mat_count+=1
-                
-                else:
-                    temp_r = offset_r
-                    temp_c = old_c
-
-                    for r in range(len(sub_mat)):
-                        for c in range(len(sub_mat[0])):
-                            mat[temp_r+r][temp_c+c] = sub_mat[r][c]
-                    
-                    temp_r = old_r
-                    temp_c = offset_c
-
-                    for r in range(len(sub_mat_T)):
-                        for c in range(len(sub_mat_T[0])):
-                            mat[temp_r+r][temp_c+c] = sub_mat_T[r][c]
-
-                    mat_count+=2
-                    if mat_count!=lim:
-                        old_c+=len(sub_mat[0])
-                        old_r+=len(sub_mat_T)
-                s_i+=1
-
-        
-            i+=1
-
-        # This is the end of making the distance matrix
-
-        # This is example matrix of size 16 x 16  the distance matrix produced by the above process.
-        # mat = [[float('inf'), 857, 791, 775, 693, 759, 772, 915, 584, 697, 609, 932, 1142, 745, 453, 797],
-        #        [827, float('inf'), 154, 290, 279, 281, 309, 221,642, 362, 416, 286, 998, 266, 945, 228],
-        #        [763, 159, float('inf'), 227, 216, 218, 246, 297,578, 276, 345, 366, 932, 148, 879, 69],
-        #        [776, 296, 230, float('inf'), 126, 70, 77, 249,479, 349, 399, 256, 838, 375, 780, 291],
-        #        [653, 252, 185, 116, float('inf'), 108, 131, 222, 448, 265, 342, 278, 805, 360, 752, 234],
-        #        [759, 290, 224, 61, 120, float('inf'), 80, 242, 462, 332, 384, 292, 822, 366, 769, 276],
-        #        [747, 314, 248, 83, 144, 81, float('inf'), 266, 471, 343, 387, 314, 804, 405, 754, 279],
-        #        [867, 221, 301, 235, 213, 226, 254, float('inf'), 661, 478, 526, 182, 893, 410, 955, 374],
-        #        [598, 685, 618, 520, 491, 509, 494, 695, float('inf'), 588, 492, 649, 1028, 722, 722, 596],
-        #        [690, 348, 269, 331, 274, 316, 319, 458, 573,float('inf'), 153, 543, 1011, 310, 958, 203],
-        #        [609, 416, 345, 399, 342, 384, 387, 526, 492,153, float('inf'), 587, 994, 350, 942, 276],
-        #        [932, 286, 366, 256, 278, 292, 314, 182, 649,543, 574, float('inf'), 723, 467, 888, 424],
-        #        [1142, 998, 932, 838, 805, 822, 804, 893, 1028,1011, 1042, 793, float('inf'), 1041, 1048, 927],
-        #        [745, 266, 148, 375, 360, 366, 405, 410, 722,310, 360, 471, 1012, float('inf'), 961, 126],
-        #        [453, 945, 879, 780, 752, 769, 754, 955, 722,958, 923, 916, 948, 988, float('inf'), 874],
-        #        [797, 228, 69, 291, 234, 276, 279, 374, 596, 203, 233, 435, 886, 115, 835, float('inf')]]
+        # So the missing pairs are packed into as few api calls as possible (see plan_requests), all the calls are made at once
+        # and then each result is put into the matrix at the rows and columns it was asked for
+        plan = plan_requests(len(addresses), known, max_elements=api_element_limit, max_side=api_limit, needed=pairs.values())
+        if plan.requests:
+            print(plan.summary())
+
+        jobs = [([addresses[r] for r in origins], [addresses[c] for c in dests]) for origins, dests in plan.rects]
+        sub_mats, error = fetch_blocks(provider.matrix, jobs, workers=fetch_workers, per_second=requests_per_second)
+
+        # The sqlite/mysql connections can not be shared between threads, so only the api calls run in the pool
+        # and the cache is written here. The blocks that came back are saved even when another one failed,
+        # so the next run does not pay for them again
+        new_values = {}
+        for (origins, dests), sub_mat in zip(plan.rects, sub_mats):
+            if sub_mat is None:
+                continue
+            place_block(mat, origins, dests, sub_mat)
+            for r_i, r in enumerate(origins):
+                for c_i, c in enumerate(dests):
+                    new_values[(addresses[r], addresses[c])] = sub_mat[r_i][c_i]
+        cache.put_many(new_values)
+        if error is not None:
+            raise error
+
+
+    # This function makes the distance matrix between all the addresses
+    # Only the pairs of addresses that are in the list of the same therapist are ever driven between, so only those are asked for,
+    # the others stay INF. Without the assignment stage that is almost every pair, with it the lists are much shorter
+    def build_matrix():
+
+        n = len(addresses)
+
+        # this is used to make a empty matrix of size len(addresses) x len(addresses) filled with INF (zero from an address to itself)
         
-        mat_copy = mat.copy()
-        t_avail_time_from = therapists_details[t_id]['availability']['time_from']
-        t_avail_time_to = therapists_details[t_id]['availability']['time_to']
-        time_zero = datetime.strptime("00:00", "%H:%M")
-        time_from = datetime.strptime(t_avail_time_from, "%H:%M")
-        time_to = datetime.strptime(t_avail_time_to, "%H:%M")
-        time_diff = (time_to - time_from).total_seconds()
-
-        # Now the following process solves the TSP
-        # Since there is no exact solution to TSP, i have used the "nearest house" approach
-        # Here for each day, first the nearest house to therapist is taken and then from there the next nearest house is taken
-        # and the schedule for each day is created
-        chosen = []
+        mat = new_matrix(n)
+        mat.fill(INF)
+        np.fill_diagonal(mat, 0)
+        needed = set()
+        for det in therapists_patients_pair.values():
+            inds = sorted(set(node_index[pid] for pid in det['patients']))
+            needed.update((i, j) for a, i in enumerate(inds) for j in inds[:a])
+        fill_exact(mat, sorted(needed))
+        return mat
+
+
+    # Each therapist only needs the rows and columns of their own patients, so their matrix is taken out of the global one
+    # The order of the rows and columns is the same as in pids, the therapist is always the first one
+    # The routing only reads it, so it is made read-only, the same matrix can be routed again for every day (and every run)
+    # For a sparse matrix it is a sparse one too (see SparseMatrix.sub)
+    def therapist_matrix(global_mat, pids: list):
+        inds = [node_index[pid] for pid in pids]
+        if isinstance(global_mat, SparseMatrix):
+            return global_mat.sub(inds)
+        mat = global_mat[np.ix_(inds, inds)]
+        mat.setflags(write=False)
+        return mat
+
+
+    # This function makes the schedule of every therapist from the given matrix
+    # It is a function so that it can be run again when some travel times of the matrix are made exact (travel_times='refine')
+    # Besides the plans it gives back legs, the pairs of addresses (indexes into addresses) that the routes really drive between
+    # and gap, how the nearest house routes did against the exact ones on the days that were solved exactly (the visits, and the
+    # driving on the days where both visit the same number of patients)
+    def plan_routes(global_mat):
+
+        therapy_plan = {}
+        p_therpay_plan = {}
         left_out = []
-        for day in therapists_details[t_id]['availability']['days']:
-            mat = mat_copy
-            for d in therapists_patients_pair[t_id]['days']:
-                if day in d:
-                    p_day_list = d[day]
-            for c in chosen:
-                if c in p_day_list:
-                    p_day_list.remove(c)
-            time = 0
+        legs = set()
+        gap = {'days': 0, 'greedy_visits': 0, 'exact_visits': 0, 'same_days': 0, 'greedy_drive': 0, 'exact_drive': 0}
+
+        # With workers > 1 the week of every therapist is first routed on its own in a pool of processes (see solve_therapist),
+        # without looking at the other therapists. Then the routes are gone through below in the same order as always and a visit
+        # is only kept if the patient's limits (one visit a day, paitient_week_visit_limit, unique_profession_limit) still allow it,
+        # so the result does not depend on which process finished first
+        proposals = None
+        if workers > 1:
+            jobs = []
+            for t_id, det in therapists_patients_pair.items():
+                availability = therapists_details[t_id]['availability']
+                time_diff = (datetime.strptime(availability['time_to'], "%H:%M")-datetime.strptime(availability['time_from'], "%H:%M")).total_seconds()
+                pos = {pid: c for c, pid in enumerate(det['patients'])}
+                days = [[pos[p] for d in det['days'] if day in d for p in d[day]] for day in availability['days']]
+                jobs.append((therapist_matrix(global_mat, det['patients']), days, time_diff, 90*60, improve_seconds, exact_size))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                proposals = dict(zip(therapists_patients_pair, pool.map(solve_therapist, *zip(*jobs))))
+
+        for t_id, det in therapists_patients_pair.items():
+
+            pids: list = therapists_patients_pair[t_id]['patients']
+            mat = therapist_matrix(global_mat, pids)
+
+            # This is the end of making the distance matrix
+
+            # This is example matrix of size 16 x 16  the distance matrix produced by the above process.
+            # mat = [[float('inf'), 857, 791, 775, 693, 759, 772, 915, 584, 697, 609, 932, 1142, 745, 453, 797],
+            #        [827, float('inf'), 154, 290, 279, 281, 309, 221,642, 362, 416, 286, 998, 266, 945, 228],
+            #        [763, 159, float('inf'), 227, 216, 218, 246, 297,578, 276, 345, 366, 932, 148, 879, 69],
+            #        [776, 296, 230, float('inf'), 126, 70, 77, 249,479, 349, 399, 256, 838, 375, 780, 291],
+            #        [653, 252, 185, 116, float('inf'), 108, 131, 222, 448, 265, 342, 278, 805, 360, 752, 234],
+            #        [759, 290, 224, 61, 120, float('inf'), 80, 242, 462, 332, 384, 292, 822, 366, 769, 276],
+            #        [747, 314, 248, 83, 144, 81, float('inf'), 266, 471, 343, 387, 314, 804, 405, 754, 279],
+            #        [867, 221, 301, 235, 213, 226, 254, float('inf'), 661, 478, 526, 182, 893, 410, 955, 374],
+            #        [598, 685, 618, 520, 491, 509, 494, 695, float('inf'), 588, 492, 649, 1028, 722, 722, 596],
+            #        [690, 348, 269, 331, 274, 316, 319, 458, 573,float('inf'), 153, 543, 1011, 310, 958, 203],
+            #        [609, 416, 345, 399, 342, 384, 387, 526, 492,153, float('inf'), 587, 994, 350, 942, 276],
+            #        [932, 286, 366, 256, 278, 292, 314, 182, 649,543, 574, float('inf'), 723, 467, 888, 424],
+            #        [1142, 998, 932, 838, 805, 822, 804, 893, 1028,1011, 1042, 793, float('inf'), 1041, 1048, 927],
+            #        [745, 266, 148, 375, 360, 366, 405, 410, 722,310, 360, 471, 1012, float('inf'), 961, 126],
+            #        [453, 945, 879, 780, 752, 769, 754, 955, 722,958, 923, 916, 948, 988, float('inf'), 874],
+            #        [797, 228, 69, 291, 234, 276, 279, 374, 596, 203, 233, 435, 886, 115, 835, float('inf')]]
+        
+            t_avail_time_from = therapists_details[t_id]['availability']['time_from']
+            t_avail_time_to = therapists_details[t_id]['availability']['time_to']
+            time_zero = datetime.strptime("00:00", "%H:%M")
+            time_from = datetime.strptime(t_avail_time_from, "%H:%M")
+            time_to = datetime.strptime(t_avail_time_to, "%H:%M")
+            time_diff = (time_to - time_from).total_seconds()
             t_time = 90*60
-            plan = {}
-            mat_r = 0
-            while len(p_day_list) > 0:
-                min = float('inf')
-                p_day_ind, mat_c = 0, 0
-                while p_day_ind < len(p_day_list):
-                    mat_c = pids.index(p_day_list[p_day_ind])
-                    if mat[mat_r][mat_c] < min:
-                        min = mat[mat_r][mat_c]
-                    p_day_ind += 1
-
-                time += t_time+min
-                if time <= time_diff:
-                    ele = pids[mat[mat_r].index(min)]
-                    cont = True
-
+            job_id = therapists_details[t_id]['job_id']
+
+            # column of every patient in mat, so that pids.index is not needed in the loop
+            pos = {pid: c for c, pid in enumerate(pids)}
+
+            # Now the following process solves the TSP
+            # Since there is no exact solution to TSP, i have used the "nearest house" approach
+            # Here for each day, first the nearest house to therapist is taken and then from there the next nearest house is taken
+            # and the schedule for each day is created
+            chosen = []
+            left_out = []
+            for day_n, day in enumerate(therapists_details[t_id]['availability']['days']):
+                for d in therapists_patients_pair[t_id]['days']:
+                    if day in d:
+                        p_day_list = [p for p in d[day] if p not in chosen]
+
+                # A patient can not get a visit if they already have one this day, or they reached the weekly limit,
+                # or the limit of visits from this profession
+                def can_visit(col):
+                    ele = pids[col]
                     if ele in p_therpay_plan:
-                        if (p_therpay_plan[ele][day]!='') or (p_therpay_plan[ele]['other_det']['total'] == paitient_week_visit_limit) or (p_therpay_plan[ele]['other_det']['u_prfs'].count(therapists_details[t_id]['job_id'])==unique_profession_limit):
-                            cont=False
-                                
-                    if cont:
-                        plan[ele] = time-t_time + \
-                            (time_from-time_zero).total_seconds()
-                        chosen.append(ele)
-                        if ele not in p_therpay_plan:
-                            p_therpay_plan[ele] = {
-                                'Mo': '', 'Tu': '', 'We': '', 'Th': '', 'Fr': '', 'other_det': {'total':0,'u_prfs':[]}}
-                        p_therpay_plan[ele][day] += t_id+"-" + str(time-t_time+(time_from-time_zero).total_seconds())
-                        p_therpay_plan[ele]['other_det']['total']+=1
-                        p_therpay_plan[ele]['other_det']['u_prfs'].append(therapists_details[t_id]['job_id'])
-
-                        p_day_list.remove(ele)
+                        if (p_therpay_plan[ele][day]!='') or (p_therpay_plan[ele]['other_det']['total'] == paitient_week_visit_limit) or (p_therpay_plan[ele]['other_det']['u_prfs'].count(job_id)==unique_profession_limit):
+                            return False
+                    return True
+
+                candidates = [pos[p] for p in p_day_list]
+                if proposals is not None:
+                    # The route the worker made for this day, without the patients that the therapists before this one used up,
+                    # the time they leave free is filled with the other candidates that are still allowed (see fill_route)
+                    route = [col for col in proposals[t_id][day_n] if col in candidates and can_visit(col)]
+                    route = fill_route(mat, route, candidates, time_diff, t_time, can_visit)
+                    stops, day_legs = route_times(mat, route, t_time)
+                    left = [col for col in candidates if col not in route]
                 else:
-                    break
-
-                mat_r = mat[mat_r].index(min)
-                for row in mat:
-                    row[mat_r] = float('inf')
-
-            if len(p_day_list) > 0:
-                for p in p_day_list:
-                    if p not in left_out:
-                        left_out.append(p)
-
+                    stops, day_legs, left = nearest_neighbour_day(mat, candidates, time_diff, t_time, can_visit)
+
+                    # A day with no more than exact_size candidates is solved exactly (see held_karp), 0 never does it
+                    # The nearest house route has crossings and detours, on the bigger days the improvement stage (see improve_route) makes
+                    # it shorter and uses the time won for more visits. It gets improve_seconds for every day, 0 keeps the nearest house route
+                    if 0 < len(candidates) <= exact_size:
+                        route = held_karp(mat, candidates, time_diff, t_time, can_visit)
+                        greedy = [col for col, start in stops]
+                        gap['days'] += 1
+                        gap['greedy_visits'] += len(greedy)
+                        gap['exact_visits'] += len(route)
+                        if len(greedy) == len(route):
+                            gap['same_days'] += 1
+                            gap['greedy_drive'] += route_drive(mat, greedy)
+                            gap['exact_drive'] += route_drive(mat, route)
+                        stops, day_legs = route_times(mat, route, t_time)
+                        left = [col for col in candidates if col not in route]
+                    elif improve_seconds > 0:
+                        route = improve_route(mat, [col for col, start in stops], candidates, time_diff, t_time, can_visit, improve_seconds)
+                        stops, day_legs = route_times(mat, route, t_time)
+                        left = [col for col in candidates if col not in route]
+                for r, c in day_legs:
+                    legs.add((node_index[pids[r]], node_index[pids[c]]))
+
+                plan = {}
+                for col, start in stops:
+                    ele = pids[col]
+                    plan[ele] = start + (time_from-time_zero).total_seconds()
+                    chosen.append(ele)
+                    if ele not in p_therpay_plan:
+                        p_therpay_plan[ele] = {
+                            'Mo': '', 'Tu': '', 'We': '', 'Th': '', 'Fr': '', 'other_det': {'total':0,'u_prfs':[]}}
+                    p_therpay_plan[ele][day] += t_id+"-" + str(start+(time_from-time_zero).total_seconds())
+                    p_therpay_plan[ele]['other_det']['total']+=1
+                    p_therpay_plan[ele]['other_det']['u_prfs'].append(job_id)
+
+                p_day_list = [pids[col] for col in left]
+
+                if len(p_day_list) > 0:
+                    for p in p_day_list:
+                        if p not in left_out:
+                            left_out.append(p)
+
+                if t_id not in therapy_plan:
+                    therapy_plan[t_id] = {}
+                therapy_plan[t_id].update({day: plan})
+
+        return therapy_plan, p_therpay_plan, left_out, legs, gap
+
+
+    # With shards every shard is first solved on its own (in workers processes when workers > 1): its therapists' routes with only
+    # the patients that are solved in this shard, which is the nearest shard where they are a candidate. Each part only needs the
+    # travel times of its own addresses. lns_seconds is shared out between the shards by their number of patients
+    # Then the border is repaired: all the routes get all their candidates back and the patients at a border (or any patient who
+    # still has room for visits) are put into the routes of the other shards where they still fit
+    def solve_shards(global_mat, routes: list, nodes: dict):
+        t_shard = {t_id: int(shards.therapist_shard[t]) for t, t_id in enumerate(t_ids)}
+        p_order = {p_id: shards.order[p] for p, p_id in enumerate(p_ids)}
+        found = {}
+        for route in routes:
+            for pid in route.candidates:
+                found.setdefault(pid, set()).add(t_shard[route.key[0]])
+        home = {pid: next(s for s in p_order[pid] if s in in_shards) for pid, in_shards in found.items()}
+
+        parts = {}
+        for r, route in enumerate(routes):
+            parts.setdefault(t_shard[route.key[0]], []).append(r)
+
+        jobs = []
+        for s, part_routes in parts.items():
+            part = [Route(routes[r].key, routes[r].home, routes[r].length, routes[r].job, [pid for pid in routes[r].candidates if home[pid] == s])
+                    for r in part_routes]
+            inds = sorted(set([route.home for route in part]+[nodes[pid] for route in part for pid in route.candidates]))
+            local = {ind: i for i, ind in enumerate(inds)}
+            for route in part:
+                route.home = local[route.home]
+            part_nodes = {pid: local[nodes[pid]] for route in part for pid in route.candidates}
+            share = lns_seconds*len(part_nodes)/max(1, len(home))
+            jobs.append((global_mat[np.ix_(inds, inds)].tolist(), part, part_nodes, 90*60, paitient_week_visit_limit, unique_profession_limit, share))
+
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(solve_part, *zip(*jobs)))
+        else:
+            results = [solve_part(*job) for job in jobs]
+
+        stops = [[] for _ in routes]
+        for part_routes, part_stops in zip(parts.values(), results):
+            for r, route_stops in zip(part_routes, part_stops):
+                stops[r] = route_stops
+
+        # The repair only puts visits in, so the global matrix can be used as it is (the routes only look up the travel times
+        # of their own therapist's list, which are all there)
+        clinic = ClinicSolver(global_mat, routes, nodes, 90*60, paitient_week_visit_limit, unique_profession_limit)
+        clinic.restore(stops)
+        clinic.construct()
+        clinic.search(lns_seconds/4)
+        return clinic
+
+
+    # Every day of every therapist (the ones in only, or all of them) as a Route for the clinic solver (see vrp.py)
+    # A patient is a candidate of it if they are in the therapist's list for that day
+    def make_routes(only=None):
+        routes = []
+        for t_id, det in therapists_patients_pair.items():
+            if only is not None and t_id not in only:
+                continue
+            availability = therapists_details[t_id]['availability']
+            time_from = datetime.strptime(availability['time_from'], "%H:%M")
+            time_to = datetime.strptime(availability['time_to'], "%H:%M")
+            for day in availability['days']:
+                candidates = []
+                for d in det['days']:
+                    if day in d:
+                        candidates = d[day]
+                routes.append(Route((t_id, day), node_index['t-'+t_id], (time_to-time_from).total_seconds(),
+                                    therapists_details[t_id]['job_id'], candidates))
+        return routes
+
+
+    # The start of every visit of a route in seconds from midnight (like in plan_routes) as {pid: start}, and the legs driven
+    def route_plan(global_mat, route: Route):
+        t_id = route.key[0]
+        time_zero = datetime.strptime("00:00", "%H:%M")
+        time_from = datetime.strptime(therapists_details[t_id]['availability']['time_from'], "%H:%M")
+        path = [route.home]+[node_index[pid] for pid in route.stops]
+        plan = {}
+        legs = []
+        time_used = 0
+        for pid, a, b in zip(route.stops, path, path[1:]):
+            time_used += global_mat[a, b]
+            plan[pid] = int(time_used) + (time_from-time_zero).total_seconds()
+            time_used += 90*60
+            legs.append((a, b))
+        return plan, legs
+
+
+    # The schedule of the whole clinic at once (see vrp.py), instead of one therapist after the other like plan_routes
+    # Every day of every therapist is a route, a patient is a candidate of it if they are in the therapist's list for that day
+    # It gives back the same things as plan_routes, left_out are the patients who did not get any visit this week
+    def plan_clinic(global_mat):
+
+        routes = make_routes()
+        nodes = {pid: node_index[pid] for pid in patient_details if pid in node_index}
+        if shards is None:
+            # the clinic solver reads the matrix as lists, a sparse matrix can be read like that as it is
+            d = global_mat if isinstance(global_mat, SparseMatrix) else global_mat.tolist()
+            clinic = ClinicSolver(d, routes, nodes, 90*60, paitient_week_visit_limit, unique_profession_limit)
+            clinic.solve(lns_seconds)
+        else:
+            clinic = solve_shards(global_mat, routes, nodes)
+
+        therapy_plan = {}
+        p_therpay_plan = {}
+        legs = set()
+        for route in routes:
+            t_id, day = route.key
+            plan, route_legs = route_plan(global_mat, route)
+            legs.update(route_legs)
             if t_id not in therapy_plan:
                 therapy_plan[t_id] = {}
             therapy_plan[t_id].update({day: plan})
 
+        for pid in nodes:
+            for r in sorted(clinic.visits.get(pid, [])):
+                t_id, day = routes[r].key
+                if pid not in p_therpay_plan:
+                    p_therpay_plan[pid] = {
+                        'Mo': '', 'Tu': '', 'We': '', 'Th': '', 'Fr': '', 'other_det': {'total':0,'u_prfs':[]}}
+                p_therpay_plan[pid][day] += t_id+"-" + str(therapy_plan[t_id][day][pid])
+                p_therpay_plan[pid]['other_det']['total']+=1
+                p_therpay_plan[pid]['other_det']['u_prfs'].append(routes[r].job)
+
+        left_out = [pid for pid in nodes if pid in clinic.visits and not clinic.visits[pid]]
+        gap = {'days': 0, 'exact_drive': 0}
+        return therapy_plan, p_therpay_plan, left_out, legs, gap
+
+
+    # The stored schedule as {id: {day: text}} of the therapists and of the patients, empty if nothing was made yet
+    def stored_schedule():
+        days_of_week = ['Mo', 'Tu', 'We', 'Th', 'Fr']
+        curs.execute("SELECT ID, Mo, Tu, We, Th, Fr FROM therapist_schedule")
+        stored = {row[0]: dict(zip(days_of_week, row[1:])) for row in curs.fetchall()}
+        curs.execute("SELECT ID, Mo, Tu, We, Th, Fr FROM patient_schedule")
+        stored_patients = {row[0]: dict(zip(days_of_week, row[1:])) for row in curs.fetchall()}
+        return stored, stored_patients
+
+
+    # The incremental mode: when changes (a ChangeSet, see changes.py) only has some patients and therapists in it, the stored schedule
+    # is read back and only the therapist-days they touch are made again: the days of the changed therapists, and the days where a
+    # changed patient was visited or could be visited. The other visits stay as they are and count towards the patients' limits.
+    # Only the travel times of the days made again are needed (mostly from the cache) and only their rows are written back
+    # Gives back False if there is no stored schedule to start from, then everything is made again
+    def reschedule():
+        days_of_week = ['Mo', 'Tu', 'We', 'Th', 'Fr']
+        stored, stored_patients = stored_schedule()
+        if not stored:
+            return False
+        changed_patients = changes.all_patients()
+
+        routes = make_routes()
+
+        # the patients of a therapist that is gone, or of a day the therapist does not work on any more, lose those visits and
+        # can be put into other days
+        days_left = set(route.key for route in routes)
+        freed = set()
+        for t_id in changes.therapists:
+            for day, text in stored.get(t_id, {}).items():
+                if (t_id, day) not in days_left:
+                    freed.update(pid for pid in (text or '').split('-') if pid != '')
+        old_stops = []
+        kept = []
+        affected = set()
+        for r, route in enumerate(routes):
+            t_id, day = route.key
+            text = stored.get(t_id, {}).get(day) or ''
+            old_stops.append([pid for pid in text.split('-') if pid != ''])
+            if t_id in changes.therapists:
+                kept.append([])
+                affected.add(r)
+                continue
+            kept.append([pid for pid in old_stops[r] if pid not in changed_patients and pid in route.candidates])
+            if kept[r] != old_stops[r] or any(pid in changed_patients or pid in freed for pid in route.candidates):
+                affected.add(r)
+
+        part = [r for r in range(len(routes)) if r in affected]
+        fixed = {}
+        for r, route in enumerate(routes):
+            if r not in affected:
+                for pid in kept[r]:
+                    fixed.setdefault(pid, []).append(route.key+(route.job,))
+
+        mat = new_matrix(len(addresses))
+        mat.fill(INF)
+        np.fill_diagonal(mat, 0)
+        needed = set()
+        for r in part:
+            inds = sorted(set([routes[r].home]+[node_index[pid] for pid in routes[r].candidates]))
+            needed.update((i, j) for a, i in enumerate(inds) for j in inds[:a])
+        fill_exact(mat, sorted(needed))
+
+        part_routes = [routes[r] for r in part]
+        nodes = {pid: node_index[pid] for route in part_routes for pid in route.candidates}
+        clinic = ClinicSolver(mat, part_routes, nodes, 90*60, paitient_week_visit_limit, unique_profession_limit, fixed=fixed)
+        clinic.restore([kept[r] for r in part])
+        clinic.construct()
+        for route in part_routes:
+            clinic.shorten(route)
+        clinic.construct()
+        print(f"rescheduled {len(part)} of {len(routes)} therapist-days")
+
+        # Writing back: the rows of the therapists with a day that was made again, and the rows of the patients whose visits changed
+        visits = {}
+        for r, route in enumerate(routes):
+            plan = route_plan(mat, route)[0] if r in affected else {}
+            for pid in route.stops if r in affected else kept[r]:
+                visits.setdefault(pid, {})[route.key[1]] = visit_text(route.key[0]+"-"+str(plan[pid])) if r in affected else None
+
+        touched = set(changed_patients)|freed
+        for r in part:
+            touched.update(old_stops[r])
+            touched.update(routes[r].stops)
+
+        for t_id in changes.therapists:
+            if t_id not in therapists_patients_pair:
+                curs.execute("DELETE FROM therapist_schedule WHERE ID=%s", (t_id,))
+        for t_id in dict.fromkeys(routes[r].key[0] for r in part):
+            if t_id in changes.therapists or t_id not in stored:
+                curs.execute("DELETE FROM therapist_schedule WHERE ID=%s", (t_id,))
+                curs.execute("INSERT INTO therapist_schedule (ID, Therapist_name) VALUES (%s,%s)", (t_id, therapists_details[t_id]['name']))
+        for t_id in changes.therapists:
+            curs.execute("DELETE FROM appointments WHERE therapist_id=%s", (t_id,))
+        rows = []
+        for r in part:
+            t_id, day = routes[r].key
+            curs.execute(f"UPDATE therapist_schedule SET {day} = (%s) WHERE ID=(%s)", ('-'.join(routes[r].stops), t_id))
+            if t_id not in changes.therapists:
+                curs.execute("DELETE FROM appointments WHERE therapist_id=%s AND day=%s", (t_id, day))
+            rows += appointments.appointment_rows(t_id, day, route_plan(mat, routes[r])[0])
+        curs.executemany(appointments.insert_query, rows)
+
+        candidates = set(nodes)|set(pid for route in routes for pid in route.candidates)
+        for p_id in touched:
+            curs.execute("DELETE FROM patient_schedule WHERE ID=%s", (p_id,))
+            curs.execute("DELETE FROM left_out_patients WHERE ID=%s", (p_id,))
+            if p_id not in patient_details:
+                continue
+            if p_id in visits:
+                curs.execute("INSERT INTO patient_schedule (ID, Patient_Name) VALUES (%s,%s)", (p_id, patient_details[p_id]['name']))
+                for day in days_of_week:
+                    if day in visits[p_id]:
+                        text = visits[p_id][day] if visits[p_id][day] is not None else stored_patients.get(p_id, {}).get(day) or ''
+                    else:
+                        text = ''
+                    curs.execute(f"UPDATE patient_schedule SET {day} = (%s) WHERE ID=(%s)", (text, p_id))
+            elif p_id in candidates:
+                curs.execute("INSERT INTO left_out_patients (ID) VALUES (%s)", (p_id,))
+        db.commit()
+        return True
+
+
+    # The local repair: when patients were only cancelled or added (changes.local()) they are just taken out of or put into the
+    # stored days, nobody else is moved to another day. The stops of a cancelled patient are taken out, an added one is put into the
+    # cheapest place (see cheapest_insertion) of the days they can be visited on, one visit after the other, as long as the day
+    # still fits into the therapist's hours and the week limits allow it (a therapist still visits a patient only once a week). Only the travel times along these days are needed
+    # (mostly from the cache) and only the rows of these days are written back
+    # Gives back False if there is no stored schedule to repair
+    def repair():
+        started = perf_counter()
+        days_of_week = ['Mo', 'Tu', 'We', 'Th', 'Fr']
+        stored, stored_patients = stored_schedule()
+        if not stored:
+            return False
+
+        routes = [route for route in make_routes() if route.key[0] in stored]
+        changed = set()
+        for r, route in enumerate(routes):
+            route.stops = [pid for pid in (stored[route.key[0]].get(route.key[1]) or '').split('-') if pid != '']
+            if any(pid in changes.cancelled for pid in route.stops):
+                route.stops = [pid for pid in route.stops if pid not in changes.cancelled]
+                changed.add(r)
+        inserted = [p_id for p_id in sorted(changes.inserted-changes.cancelled) if p_id in node_index]
+        options = {p_id: [r for r, route in enumerate(routes) if p_id in route.candidates] for p_id in inserted}
+
+        # the legs of the days that change, and from every added patient to the places of the days they can go into
+        mat = new_matrix(len(addresses))
+        mat.fill(INF)
+        np.fill_diagonal(mat, 0)
+        needed = set()
+        for r, route in enumerate(routes):
+            path = [route.home]+[node_index[pid] for pid in route.stops]
+            places = [node_index[p_id] for p_id in inserted if r in options[p_id]]
+            if r in changed or places:
+                needed.update((max(a, b), min(a, b)) for a, b in zip(path, path[1:]) if a != b)
+            for x in places:
+                needed.update((max(a, x), min(a, x)) for a in path+places if a != x)
+        fill_exact(mat, sorted(needed))
+
+        def duration(route: Route):
+            path = [route.home]+[node_index[pid] for pid in route.stops]
+            return sum(int(mat[a, b]) for a, b in zip(path, path[1:]))+90*60*len(route.stops)
+
+        for p_id in inserted:
+            x = node_index[p_id]
+            while True:
+                on = [r for r in options[p_id] if p_id in routes[r].stops]
+                if len(on) >= paitient_week_visit_limit:
+                    break
+                best = None
+                for r in options[p_id]:
+                    route = routes[r]
+                    if r in on or route.key[1] in [routes[v].key[1] for v in on] or route.key[0] in [routes[v].key[0] for v in on]:
+                        continue
+                    if [routes[v].job for v in on].count(route.job) >= unique_profession_limit:
+                        continue
+                    cost, pos = cheapest_insertion(mat, [route.home]+[node_index[pid] for pid in route.stops], x)
+                    if duration(route)+int(cost)+90*60 > route.length:
+                        continue
+                    if best is None or cost < best[0]:
+                        best = (cost, r, pos)
+                if best is None:
+                    break
+                cost, r, pos = best
+                routes[r].stops.insert(pos, p_id)
+                changed.add(r)
+
+        # Writing back: the changed days of the therapists, and the days of the patients on them (their times can move)
+        texts = {}
+        rows = []
+        for r in sorted(changed):
+            t_id, day = routes[r].key
+            curs.execute(f"UPDATE therapist_schedule SET {day} = (%s) WHERE ID=(%s)", ('-'.join(routes[r].stops), t_id))
+            plan = route_plan(mat, routes[r])[0]
+            for pid in routes[r].stops:
+                texts.setdefault(pid, {})[day] = visit_text(t_id+"-"+str(plan[pid]))
+            curs.execute("DELETE FROM appointments WHERE therapist_id=%s AND day=%s", (t_id, day))
+            rows += appointments.appointment_rows(t_id, day, plan)
+        curs.executemany(appointments.insert_query, rows)
+
+        for p_id in changes.cancelled:
+            curs.execute("DELETE FROM patient_schedule WHERE ID=%s", (p_id,))
+            curs.execute("DELETE FROM left_out_patients WHERE ID=%s", (p_id,))
+        for p_id in inserted:
+            curs.execute("DELETE FROM left_out_patients WHERE ID=%s", (p_id,))
+            if p_id in texts and p_id not in stored_patients:
+                curs.execute("INSERT INTO patient_schedule (ID, Patient_Name) VALUES (%s,%s)", (p_id, patient_details[p_id]['name']))
+                texts[p_id] = {day: texts[p_id].get(day, '') for day in days_of_week}
+            elif p_id not in texts and p_id not in stored_patients:
+                curs.execute("INSERT INTO left_out_patients (ID) VALUES (%s)", (p_id,))
+        for p_id, days in texts.items():
+            for day, text in days.items():
+                curs.execute(f"UPDATE patient_schedule SET {day} = (%s) WHERE ID=(%s)", (text, p_id))
+        db.commit()
+        print(f"repaired {len(changed)} therapist-days in {(perf_counter()-started)*1000:.1f} ms")
+        return True
+
+
+    def close():
+        if own_cache:
+            cache.close()
+        if own_geocode_cache and geocode_cache is not None:
+            geocode_cache.close()
+        if own_provider:
+            provider.close()
+
+    if changes is not None and changes.local() and repair():
+        close()
+        return
+    if changes is not None and not changes.full and changes and reschedule():
+        close()
+        return
+
+
+    # solver decides how the schedule is made:
+    # 'clinic'  all the therapists at once (plan_clinic), the patients are shared out so that as many as possible get their visits
+    # 'greedy'  one therapist after the other with the nearest house routes (plan_routes), exact_size and improve_seconds are only used here
+    schedule = plan_clinic if solver == 'clinic' else plan_routes
+
+    # travel_times decides where the matrix comes from:
+    # 'exact'    every pair is asked from the distance provider (or the cache)
+    # 'estimate' every pair is guessed from the geocoded positions of the addresses (see geocode.py), no distance api calls at all
+    # 'refine'   first the guessed matrix is used to make the schedule, then only the legs of the routes are made exact and the schedule
+    #            is made again, until the routes only use exact travel times (or refine_rounds is reached)
+    # 'nearest'  every pair is guessed like in 'estimate', then in every therapist's list the travel times from each address to its
+    #            nearest_k nearest ones (found with a grid, see spatial.py) are asked for. The routes go from one house to a near one,
+    #            so these are the travel times that matter, and there are about n*nearest_k of them instead of n*n
+    # 'sparse'   the same pairs as 'nearest' and the ones from every therapist to all of their list (the first leg of a day can go to any
+    #            of them), but the matrix only keeps these exact travel times (see sparse_matrix.py) and guesses the others when they
+    #            are read, so it does not take n*n memory either
+    result = None   # the schedule, if it was already made on the final matrix ('refine')
+    if travel_times == 'exact':
+        global_mat = build_matrix()
+    else:
+        coords = positions(addresses)
+        global_mat = SparseMatrix(coords) if travel_times == 'sparse' else estimate_matrix(coords)
+
+        if travel_times in ('nearest', 'sparse'):
+            plane = to_plane(coords)
+            needed = set()
+            near = 0
+            full = 0
+            for t_id, det in therapists_patients_pair.items():
+                inds = sorted(set(node_index[pid] for pid in det['patients']))
+                pairs = nearest_pairs(plane[inds], nearest_k)
+                needed.update((inds[i], inds[j]) for i, j in pairs)
+                near += len(pairs)
+                full += len(inds)*(len(inds)-1)//2
+                if travel_times == 'sparse':
+                    home = node_index['t-'+t_id]
+                    needed.update((max(home, i), min(home, i)) for i in inds if i != home)
+            print(f"the therapists' lists have {near} nearest pairs out of {full} pairs, {len(needed)} different ones are asked for")
+            fill_exact(global_mat, sorted(needed))
+
+        # the schedule whose legs are all exact is kept, it is only made again if the last round made new legs exact
+        if travel_times == 'refine':
+            exact = set()
+            for _ in range(refine_rounds):
+                result = schedule(global_mat)
+                needed = set((max(i, j), min(i, j)) for i, j in result[3] if i != j)-exact
+                if not needed:
+                    break
+                fill_exact(global_mat, list(needed))
+                exact |= needed
+                result = None
 
+    print(matrix_memory(global_mat))
+    if result is None:
+        result = schedule(global_mat)
+    therapy_plan, p_therpay_plan, left_out, legs, gap = result
+    if gap['days']:
+        print(f"{gap['days']} days solved exactly: nearest house {gap['greedy_visits']} visits, exact {gap['exact_visits']} visits")
+    if gap['exact_drive']:
+        print(f"on the {gap['same_days']} days with the same visits the nearest house routes drive {gap['greedy_drive']//60} min, "
+              f"exact {gap['exact_drive']//60} min ({(gap['greedy_drive']/gap['exact_drive']-1)*100:.1f}% more)")
 
-    # Uploading the schedule to mysql:
 
-    curs.execute("DELETE FROM therapist_schedule")
-    db.commit()
+    # Uploading the schedule to mysql:
+    # Every row is made whole here first. With publish='diff' the stored rows are read and only the ones that differ are written,
+    # in one transaction (see diff_tables in publish.py), a rerun that moves a few visits only writes a few rows.
+    # With publish='swap' the tables are written as shadow tables and swapped in at once (see publish.py), the gui never sees an
+    # empty or half written schedule and the last one is kept for rollback_schedule.
+    # With publish='replace' the tables are emptied and filled in place, one executemany (mysql.connector makes a single INSERT
+    # with many rows out of it) and one commit per table
+    # A day the therapist does not work on stays NULL like before, the days of a patient without a visit are ''
+    days_of_week = ['Mo', 'Tu', 'We', 'Th', 'Fr']
+
+    therapist_rows = []
+    for t_id, sch in therapy_plan.items():
+        therapist_rows.append((t_id, therapists_details[t_id]['name'])+tuple('-'.join(sch[day]) if day in sch else None for day in days_of_week))
 
+    appointment_rows = []
     for t_id, sch in therapy_plan.items():
-        query = """INSERT INTO therapist_schedule (ID, Therapist_name) VALUES (%s,%s)"""
-        curs.execute(query, (t_id, therapists_details[t_id]['name']))
-        for day_sch, p in sch.items():
-            pid_s = ''
-            for p_id, time in p.items():
-                pid_s += p_id+'-'
-            pid_s = pid_s[:len(pid_s)-1]
-            query = f"UPDATE therapist_schedule SET {day_sch} = (%s) WHERE ID=(%s)"
-            curs.execute(query, (pid_s, t_id))
+        for day, plan in sch.items():
+            appointment_rows += appointments.appointment_rows(t_id, day, plan)
+
+    patient_rows = []
+    for p_id, p_sch in p_therpay_plan.items():
+        patient_rows.append((p_id, patient_details[p_id]['name'])+tuple(visit_text(p_sch[day]) for day in days_of_week))
+
+    tables = {
+        'therapist_schedule': (['ID', 'Therapist_name']+days_of_week, therapist_rows),
+        'patient_schedule': (['ID', 'Patient_Name']+days_of_week, patient_rows),
+        'left_out_patients': (['ID'], [(id,) for id in left_out]),
+        'appointments': (appointments.columns, appointment_rows),
+    }
+    if publish == 'diff':
+        counts = diff_tables(db, tables, keys={'appointments': appointments.key_columns})
+        for name, (inserted, updated, deleted) in counts.items():
+            print(f"{name}: {inserted} rows inserted, {updated} updated, {deleted} deleted")
+    elif publish == 'swap':
+        publish_tables(db, tables)
+    else:
+        for name, (columns, rows) in tables.items():
+            curs.execute(f"DELETE FROM {name}")
+            curs.executemany(f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({','.join(['%s']*len(columns))})", rows)
             db.commit()
 
+    close()
 
-    curs.execute("DELETE FROM patient_schedule")
-    db.commit()
-    for p_id, p_sch in p_therpay_plan.items():
-        query = """INSERT INTO patient_schedule (ID, Patient_Name) VALUES (%s,%s)"""
-        curs.execute(query, (p_id, patient_details[p_id]['name']))
-        for day, t_id_plus_time in p_sch.items():
-            if day!='other_det':
-                query = f"UPDATE patient_schedule SET {day} = (%s) WHERE ID=(%s)"
-                temp = t_id_plus_time.split(',')
-                for ele in temp:
-                    t = ele.split('-')
-
-                    if t[0] != '':
-                        formated_time = str(timedelta(seconds=float(t[1])))
-                        t[1] = formated_time
-                        temp[temp.index(ele)] = '-'.join(t)
-                temp = ','.join(temp)
-                curs.execute(query, (temp[:len(temp)-1], p_id))
-                db.commit()
-
-
-    curs.execute("DELETE FROM left_out_patients")
-    db.commit()
-    for id in left_out:
-        query = """INSERT INTO left_out_patients (ID) VALUES (%s)"""
-        curs.execute(query,(id,))
-        db.commit()
+
+# Puts the schedule from before the last full run back (and the newer one aside, so calling it again undoes it)
+def rollback_schedule(MYSQL_HOST,MYSQL_USER,MYSQL_PASSWORD,MYSQL_DB):
+    db = mc.connect(host=MYSQL_HOST, user=MYSQL_USER,
+                password=MYSQL_PASSWORD, database=MYSQL_DB)
+    rollback_tables(db, ['therapist_schedule', 'patient_schedule', 'left_out_patients', 'appointments'])
+    db.close()
 
 
 # This was the slower method to get the distance between two patients or one patient and one therapist
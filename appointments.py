@@ -0,0 +1,34 @@
+# The schedule as one row per visit instead of the dash joined strings in the Mo..Fr columns of therapist_schedule and
+# patient_schedule (those are still written, for anything that reads them). The gui loads a whole day of a therapist, or the whole
+# week of a therapist or a patient, with one query on an index instead of splitting the strings and asking for every id on its own
+#   (therapist_id, day, sequence)  the primary key, the visits of a therapist in the order they are driven to
+#   (patient_id, day)              the week of a patient
+#   (day, start_seconds)           everything on one day in the order of the time
+# start_seconds is the start of the visit in seconds from midnight
+
+create_query = """CREATE TABLE IF NOT EXISTS appointments (
+                    therapist_id VARCHAR(32) NOT NULL,
+                    day CHAR(2) NOT NULL,
+                    sequence INT NOT NULL,
+                    patient_id VARCHAR(32) NOT NULL,
+                    start_seconds INT NOT NULL,
+                    PRIMARY KEY (therapist_id, day, sequence),
+                    INDEX appointments_patient (patient_id, day),
+                    INDEX appointments_day (day, start_seconds))"""
+
+columns = ['therapist_id', 'day', 'sequence', 'patient_id', 'start_seconds']
+key_columns = 3
+
+insert_query = f"INSERT INTO appointments ({', '.join(columns)}) VALUES ({','.join(['%s']*len(columns))})"
+
+
+def create_appointments(db):
+    curs = db.cursor()
+    curs.execute(create_query)
+    db.commit()
+    curs.close()
+
+
+# The rows of one day of a therapist from the plan of the day ({pid: start}, in the order of the visits), sequence starts at 1
+def appointment_rows(t_id, day, plan: dict):
+    return [(t_id, day, sequence, pid, int(start)) for sequence, (pid, start) in enumerate(plan.items(), 1)]
@@ -0,0 +1,109 @@
+import itertools
+import random
+import time
+
+import numpy as np
+
+
+# Shares the needs (one patient who needs one profession) out to the therapists before any route is made, as a min cost flow:
+#   source -> need         capacity choices, a need goes to at most that many therapists
+#   need   -> therapist    capacity 1, cost[n, t] (np.inf if the therapist can not take the need at all)
+#   therapist -> sink      capacity capacity[t], how many needs the therapist has time for in a week
+# The flow is sent one unit at a time along the cheapest path that is left (successive shortest paths), which gives the cheapest
+# way to send as much as possible. The graph only has two layers, so the shortest paths are found with a few numpy passes over
+# the need x therapist matrix (Bellman-Ford, the used edges can be taken back at minus their cost) instead of a general graph search
+# Gives back a boolean need x therapist matrix of the edges used
+def min_cost_assignment(cost, capacity, choices=1):
+    cost = np.asarray(cost, dtype=np.float64)
+    n_needs, n_ther = cost.shape
+    used = np.zeros((n_needs, n_ther), dtype=bool)
+    left = np.array(capacity, dtype=np.int64)
+    possible = np.isfinite(cost)
+    finite = np.where(possible, cost, 0.0)
+    needs = np.arange(n_needs)
+    ther = np.arange(n_ther)
+
+    while True:
+        spare = used.sum(axis=1) < choices
+        if not spare.any() or not (left > 0).any():
+            break
+
+        dist_n = np.where(spare, 0.0, np.inf)
+        came_n = np.full(n_needs, -1)
+        dist_t = np.full(n_ther, np.inf)
+        came_t = np.full(n_ther, -1)
+        while True:
+            forward = np.where(possible & ~used, dist_n[:, None]+cost, np.inf)
+            best_n = forward.argmin(axis=0)
+            via_n = forward[best_n, ther]
+            better_t = via_n < dist_t
+            dist_t[better_t] = via_n[better_t]
+            came_t[better_t] = best_n[better_t]
+
+            backward = np.where(used, dist_t[None, :]-finite, np.inf)
+            best_t = backward.argmin(axis=1)
+            via_t = backward[needs, best_t]
+            better_n = via_t < dist_n
+            dist_n[better_n] = via_t[better_n]
+            came_n[better_n] = best_t[better_n]
+
+            if not better_t.any() and not better_n.any():
+                break
+
+        ends = np.where(left > 0, dist_t, np.inf)
+        t = int(ends.argmin())
+        if not np.isfinite(ends[t]):
+            break
+
+        left[t] -= 1
+        while True:
+            n = int(came_t[t])
+            used[n, t] = True
+            if came_n[n] < 0:
+                break
+            t = int(came_n[n])
+            used[n, t] = False
+
+    return used
+
+
+# How many visits fit in a week of the therapist: on each of the days the visits and the driving to them (guessed as drive seconds
+# per visit) have to fit into time_diff seconds
+def week_capacity(days: int, time_diff, drive, visit_time=90*60):
+    return days*int(time_diff//(visit_time+drive))
+
+
+# Checks min_cost_assignment against brute force on small random instances: every set of need -> therapist edges that keeps to
+# choices and the capacities is tried, the best one sends the most needs and then costs the least, and the edges used by
+# min_cost_assignment have to send as many needs for the same cost. Some edges are not possible (inf) and the capacities are
+# small, so not every need gets a therapist
+def benchmark_assignment(sizes=((3, 2), (4, 3), (5, 3)), instances=30, seed=0):
+    rnd = random.Random(seed)
+    for n_needs, n_ther in sizes:
+        same = 0
+        took = 0.0
+        for _ in range(instances):
+            cost = np.array([[rnd.randint(1, 50) if rnd.random() < 0.75 else np.inf for _ in range(n_ther)] for _ in range(n_needs)])
+            capacity = [rnd.randint(0, 2) for _ in range(n_ther)]
+            choices = rnd.randint(1, 2)
+
+            start = time.perf_counter()
+            used = min_cost_assignment(cost, capacity, choices)
+            took += time.perf_counter()-start
+
+            edges = [(n, t) for n in range(n_needs) for t in range(n_ther) if np.isfinite(cost[n, t])]
+            best = (0, 0.0)
+            for picks in itertools.product((False, True), repeat=len(edges)):
+                chosen = [edge for edge, pick in zip(edges, picks) if pick]
+                if any(sum(1 for n, t in chosen if n == need) > choices for need in range(n_needs)):
+                    continue
+                if any(sum(1 for n, t in chosen if t == ther) > capacity[ther] for ther in range(n_ther)):
+                    continue
+                best = min(best, (-len(chosen), sum(cost[n, t] for n, t in chosen)))
+            same += (-int(used.sum()), float(cost[used].sum())) == best
+        print(f"{n_needs} needs x {n_ther} therapists: min_cost_assignment {took/instances*1000:.2f} ms, "
+              f"same as brute force on {same} of {instances} instances")
+
+
+if __name__ == '__main__':
+    benchmark_assignment()
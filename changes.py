@@ -0,0 +1,47 @@
+# What was changed in the database since the schedule was made (by the gui), so that find_schedule can only make the affected
+# parts of the schedule again (see reschedule in algo_v2) instead of the whole clinic
+# patients are the patients that were edited, therapists the ones that were added, edited or deleted, full means that something else changed (a profession,
+# or nothing is known about the stored schedule yet) and everything has to be made again
+# cancelled and inserted are patients that were taken out or added (an urgent one), when nothing else changed they are only
+# taken out of or put into the stored days and the rest of the schedule stays as it is (see repair in algo_v2)
+class ChangeSet:
+
+    def __init__(self):
+        self.patients = set()
+        self.therapists = set()
+        self.cancelled = set()
+        self.inserted = set()
+        self.full = False
+
+    def __bool__(self):
+        return self.full or bool(self.patients) or bool(self.therapists) or bool(self.cancelled) or bool(self.inserted)
+
+    # whether the changes can be repaired in place
+    def local(self):
+        return not self.full and not self.patients and not self.therapists and bool(self.cancelled or self.inserted)
+
+    # every patient that changed in some way
+    def all_patients(self):
+        return self.patients|self.cancelled|self.inserted
+
+    def patient(self, p_id):
+        self.patients.add(p_id)
+
+    def therapist(self, t_id):
+        self.therapists.add(t_id)
+
+    def cancel(self, p_id):
+        self.cancelled.add(p_id)
+
+    def insert(self, p_id):
+        self.inserted.add(p_id)
+
+    def everything(self):
+        self.full = True
+
+    def clear(self):
+        self.patients = set()
+        self.therapists = set()
+        self.cancelled = set()
+        self.inserted = set()
+        self.full = False
@@ -0,0 +1,171 @@
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+
+# The travel time matrix is a n x n numpy array of int32 seconds, a pair that can not be driven (or that the routing
+# has to skip) has INF in it. int32 is enough for 68 years of driving and takes a quarter of the memory of python floats in a list
+INF = np.iinfo(np.int32).max
+
+
+def new_matrix(n: int):
+    return np.zeros((n, n), dtype=np.int32)
+
+
+# Puts a block given by the api at the rows origins and the columns dests, and the same block transposed (just a view,
+# nothing is copied) at the mirrored place, because the travel time is taken as the same in both directions
+def place_block(mat, origins: list, dests: list, sub_mat):
+    block = np.asarray(sub_mat, dtype=np.int32)
+    mat[np.ix_(origins, dests)] = block
+    mat[np.ix_(dests, origins)] = block.T
+
+
+# How much memory the matrix takes, next to what the same matrix would take as python lists of ints
+def matrix_memory(mat):
+    n = len(mat)
+    as_lists = n*(sys.getsizeof([])+8*n)+n*n*sys.getsizeof(10**4)
+    return f"travel time matrix {n}x{n}: {mat.nbytes/1024:.1f} KiB (about {as_lists/1024:.1f} KiB as python lists)"
+
+
+# The api said to slow down (OVER_QUERY_LIMIT) or had a passing problem on its side, asking again a bit later can work
+class TransientError(Exception):
+    pass
+
+
+# Only these are tried again by fetch_blocks: the connection failed or timed out, the server answered with an http error
+# or the api said the error is transient. Anything else (a bad key, a wrong request...) fails the same way every time
+TRANSIENT_ERRORS = (TransientError, requests.ConnectionError, requests.Timeout, requests.HTTPError)
+
+
+# Makes sure that no more than per_second requests are started in one second, no matter how many threads are asking
+# Each caller reserves the next free time slot and then sleeps (outside the lock) until that slot comes
+class RateLimiter:
+
+    def __init__(self, per_second):
+        self.interval = 1/per_second if per_second else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot+self.interval
+        if slot > now:
+            time.sleep(slot-now)
+
+
+# fetch is the function that actually calls the api (find_schedule passes provider.matrix, see distance_provider.py) and jobs is a
+# list of (origins, destinations) for it
+# The jobs are sent at the same time from a pool of threads, so the total time is bound by the rate limit and
+# not by the sum of all the round trips. A job that fails with one of TRANSIENT_ERRORS is tried again after backoff, 2*backoff,
+# 4*backoff... seconds, any other error is not tried again
+# Gives back (results, error): results has the sub matrix of every job in the same order as the jobs, or None for a job that failed,
+# error is the first error (None when every job went through). Once a job failed for good the jobs that did not start yet are
+# not sent anymore, but the ones that came back are still given back, so the caller can save what was paid for before raising error
+def fetch_blocks(fetch, jobs: list, workers=8, per_second=10, retries=3, backoff=1.0):
+    if not jobs:
+        return [], None
+
+    limiter = RateLimiter(per_second)
+    errors = []
+
+    def run(job):
+        attempt = 0
+        while not errors:
+            limiter.wait()
+            try:
+                return fetch(*job)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= retries:
+                    errors.append(e)
+                    return None
+                time.sleep(backoff*(2**attempt))
+                attempt += 1
+            except Exception as e:
+                errors.append(e)
+                return None
+        return None
+
+    if workers <= 1 or len(jobs) == 1:
+        results = [run(job) for job in jobs]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(pool.map(run, jobs))
+    return results, (errors[0] if errors else None)
+
+
+# This is the list of api requests that build_matrix is going to make
+# rects is a list of (origins, destinations) where both are lists of indexes into the list of addresses
+# square_requests is the number of requests the old way of asking for 10 x 10 blocks would have needed, so the two can be compared
+class RequestPlan:
+
+    def __init__(self, rects: list, square_requests: int):
+        self.rects = rects
+        self.square_requests = square_requests
+        self.requests = len(rects)
+        self.elements = sum(len(origins)*len(dests) for origins, dests in rects)
+
+    def summary(self):
+        return f"{self.requests} distance api requests ({self.elements} elements) planned, {self.square_requests} with square blocks"
+
+
+# The api does not really limit the number of origins and destinations to 10 each, the limit is on elements (origins x destinations)
+# per request, and a side can go up to max_side addresses. So instead of 10 x 10 blocks the missing pairs are packed into
+# rectangles that use as much of the element budget as possible
+#
+# The travel time from a to b is taken to be the same as from b to a (the old block method did the same by transposing the blocks),
+# so only the pairs (i, j) with j < i are needed. By default that is every such pair, a pair is skipped if it is in known,
+# ie. it is already in the cache. When only a few pairs are wanted they can be given as needed instead.
+# The origins are cut into bands of `height` addresses, all the destinations that a band still needs are split into chunks of `width`
+# and each chunk becomes one request with only the origins of the band that need something in it.
+# Every useful height is tried and the one which gives the fewest requests is used
+def plan_requests(n: int, known=(), max_elements=100, max_side=25, block_side=10, needed=None):
+    if needed is None:
+        needs = [[j for j in range(i) if (i, j) not in known] for i in range(n)]
+    else:
+        needs = [[] for _ in range(n)]
+        for i, j in sorted(set(needed)):
+            if (i, j) not in known:
+                needs[i].append(j)
+
+    square_blocks = set()
+    for i in range(n):
+        for j in needs[i]:
+            square_blocks.add((i//block_side, j//block_side))
+
+    # For every width only the biggest height that still fits in the budget is worth trying
+    heights = {}
+    for height in range(1, min(max_side, max_elements)+1):
+        width = min(max_side, max_elements//height)
+        heights[width] = height
+
+    best = None
+    for width, height in heights.items():
+        rects = []
+        for start in range(0, n, height):
+            band = [i for i in range(start, min(start+height, n)) if needs[i]]
+            if not band:
+                continue
+            dests = sorted(set(j for i in band for j in needs[i]))
+            pos = {j: ind for ind, j in enumerate(dests)}
+
+            chunk_origins = [[] for _ in range(0, len(dests), width)]
+            for i in band:
+                for chunk in sorted(set(pos[j]//width for j in needs[i])):
+                    chunk_origins[chunk].append(i)
+
+            for chunk, origins in enumerate(chunk_origins):
+                rects.append((origins, dests[chunk*width:(chunk+1)*width]))
+
+        plan = RequestPlan(rects, len(square_blocks))
+        if best is None or (plan.requests, plan.elements) < (best.requests, best.elements):
+            best = plan
+
+    return best
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from distance_matrix import TransientError, INF
+from travel_cache import normalize_address
+
+
+# A distance provider is anything that can give back the travel times (in seconds) from every origin to every destination
+# matrix(origins, destinations) takes two lists of addresses and gives back a len(origins) x len(destinations) list of lists
+# max_side and max_elements are the limits of one call, build_matrix uses them to plan the calls
+class DistanceProvider:
+
+    max_side = 25
+    max_elements = 100
+
+    def matrix(self, origins: list, destinations: list):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# Google distance matrix api
+# The api can take up to 25 origins or 25 destinations in one call, but not more than 100 elements (origins x destinations),
+# so 10 origins and 10 destinations is fine and so is 4 origins and 25 destinations
+class GoogleDistanceProvider(DistanceProvider):
+
+    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
+
+    def __init__(self, key="", url=None, timeout=30):
+        self.key = key
+        self.timeout = timeout
+        if url is not None:
+            self.url = url
+
+    def matrix(self, origins: list, destinations: list):
+        params = {
+            "origins": '|'.join(origins),
+            "destinations": '|'.join(destinations),
+            "units": "imperial",
+            "key": self.key
+        }
+
+        response = requests.request("GET", self.url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        # When the quota is used up the api still answers with 200 but the status is OVER_QUERY_LIMIT, that one (and UNKNOWN_ERROR)
+        # is raised as transient so fetch_blocks tries again, any other status (a bad key, too many elements...) would fail again
+        if data.get('status', 'OK') in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'):
+            raise TransientError(f"distance api returned {data['status']}")
+        if data.get('status', 'OK') != 'OK':
+            raise RuntimeError(f"distance api returned {data['status']}")
+
+        # An element that is not OK (NOT_FOUND, ZERO_RESULTS: no road between the two) has no duration, it is INF like a pair
+        # that can not be driven, so the rest of the block is still used
+        matrix = []
+        for row in data['rows']:
+            n_row = []
+            for col in row['elements']:
+                n_row.append(col['duration']['value'] if col.get('status', 'OK') == 'OK' else INF)
+            matrix.append(n_row)
+        return matrix
+
+
+# This is the make_matrix(rand=True) idea, but the same pair of addresses always gets the same random travel time (for the same seed),
+# in both directions, and the same address to itself is 0. It needs no network so it can be used to test and benchmark find_schedule
+class SyntheticDistanceProvider(DistanceProvider):
+
+    def __init__(self, seed=0, low=200, high=2000, latency=0.0):
+        self.seed = seed
+        self.low = low
+        self.high = high
+        self.latency = latency
+
+    def travel_time(self, origin: str, dest: str):
+        origin = normalize_address(origin)
+        dest = normalize_address(dest)
+        if origin == dest:
+            return 0
+        pair = '\x00'.join(sorted((origin, dest)))
+        digest = hashlib.sha1(f"{self.seed}\x00{pair}".encode('utf-8')).digest()
+        return random.Random(digest).randint(self.low, self.high)
+
+    def matrix(self, origins: list, destinations: list):
+        if self.latency:
+            time.sleep(self.latency)
+        return [[self.travel_time(o, d) for d in destinations] for o in origins]
+
+
+# A small http server that answers like the google api, but the travel times come from another provider (synthetic by default)
+# With latency it can be used to load test the whole http path (thread pool, rate limit, retries) without using the real api
+# port 0 means any free port, the real one is in server.url after start()
+class LocalDistanceServer:
+
+    def __init__(self, provider=None, host="127.0.0.1", port=0, latency=0.0):
+        self.provider = provider if provider is not None else SyntheticDistanceProvider()
+        self.latency = latency
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                origins = [addr for addr in query.get('origins', [''])[0].split('|') if addr != '']
+                dests = [addr for addr in query.get('destinations', [''])[0].split('|') if addr != '']
+                if server.latency:
+                    time.sleep(server.latency)
+
+                if not origins or not dests or len(origins)*len(dests) > server.provider.max_elements:
+                    body = {'status': 'MAX_ELEMENTS_EXCEEDED' if origins and dests else 'INVALID_REQUEST', 'rows': []}
+                else:
+                    mat = server.provider.matrix(origins, dests)
+                    body = {'status': 'OK', 'origin_addresses': origins, 'destination_addresses': dests,
+                            'rows': [{'elements': [{'status': 'OK', 'duration': {'value': val}} for val in row]} for row in mat]}
+
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.httpd.server_address[1]}/maps/api/distancematrix/json"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# The google provider pointed at a LocalDistanceServer which is started with it and stopped on close()
+class LocalServerProvider(GoogleDistanceProvider):
+
+    def __init__(self, seed=0, latency=0.0):
+        self.server = LocalDistanceServer(SyntheticDistanceProvider(seed), latency=latency).start()
+        super().__init__(url=self.server.url)
+
+    def close(self):
+        self.server.stop()
+
+
+# road_graph.py imports this module, so it is only imported when the road graph provider is really asked for
+def road_graph_provider(**options):
+    from road_graph import RoadGraphProvider
+    return RoadGraphProvider(**options)
+
+
+PROVIDERS = {
+    'google': GoogleDistanceProvider,
+    'synthetic': SyntheticDistanceProvider,
+    'local': LocalServerProvider,
+    'road_graph': road_graph_provider,
+}
+
+
+# Makes the provider from the configuration, which can be the name of a provider ('google', 'synthetic' or 'local')
+# or a dictionary like {'name': 'synthetic', 'seed': 3} or {'name': 'road_graph', 'path': 'graph.bin', 'address_nodes': 'nodes.csv'}, the other keys are given to the provider
+# When nothing is given the DISTANCE_PROVIDER environment variable is used and the api key is taken from DISTANCE_API_KEY
+def make_provider(config=None):
+    if config is None:
+        config = os.environ.get('DISTANCE_PROVIDER', 'google')
+    if isinstance(config, str):
+        config = {'name': config}
+
+    options = dict(config)
+    name = options.pop('name', 'google')
+    if name not in PROVIDERS:
+        raise ValueError(f"unknown distance provider {name!r}, it should be one of {', '.join(PROVIDERS)}")
+    if name == 'google' and 'key' not in options:
+        options['key'] = os.environ.get('DISTANCE_API_KEY', '')
+    return PROVIDERS[name](**options)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python distance_provider.py 8080 starts the stand-in server on that port until it is stopped with ctrl+c
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    stand_in = LocalDistanceServer(port=port)
+    print(f"distance api stand-in listening on {stand_in.url}")
+    try:
+        stand_in.httpd.serve_forever()
+    except KeyboardInterrupt:
+        stand_in.httpd.server_close()
@@ -0,0 +1,153 @@
+import hashlib
+import math
+import random
+import sqlite3
+import time
+
+import numpy as np
+import requests
+
+from distance_matrix import fetch_blocks, TransientError
+from travel_cache import normalize_address
+
+
+# Google geocoding api, gives back (lat, lng) of an address
+class GoogleGeocoder:
+
+    url = "https://maps.googleapis.com/maps/api/geocode/json"
+
+    def __init__(self, key="", url=None, timeout=30):
+        self.key = key
+        self.timeout = timeout
+        if url is not None:
+            self.url = url
+
+    def geocode(self, addr: str):
+        response = requests.request("GET", self.url, params={"address": addr, "key": self.key}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data.get('status') in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'):
+            raise TransientError(f"geocoding api returned {data['status']} for {addr!r}")
+        if data.get('status') != 'OK':
+            raise RuntimeError(f"geocoding api returned {data.get('status')} for {addr!r}")
+        location = data['results'][0]['geometry']['location']
+        return location['lat'], location['lng']
+
+
+# Gives every address a made up position (always the same one for the same address and seed) within radius_km of center,
+# it is used together with the synthetic distance provider to test without network
+class SyntheticGeocoder:
+
+    def __init__(self, seed=0, center=(52.52, 13.40), radius_km=15.0):
+        self.seed = seed
+        self.center = center
+        self.radius_km = radius_km
+
+    def geocode(self, addr: str):
+        digest = hashlib.sha1(f"{self.seed}\x00{normalize_address(addr)}".encode('utf-8')).digest()
+        rnd = random.Random(digest)
+        dist = self.radius_km*math.sqrt(rnd.random())
+        angle = rnd.uniform(0, 2*math.pi)
+        lat = self.center[0]+dist*math.cos(angle)/111.32
+        lng = self.center[1]+dist*math.sin(angle)/(111.32*math.cos(math.radians(self.center[0])))
+        return lat, lng
+
+
+# Keeps the position of every address that was geocoded once, houses do not move so by default the entries never expire
+class GeocodeCache:
+
+    placeholder = '?'
+    create_query = """CREATE TABLE IF NOT EXISTS geocode_cache (
+                        addr_key CHAR(40) PRIMARY KEY,
+                        address TEXT NOT NULL,
+                        lat DOUBLE NOT NULL,
+                        lng DOUBLE NOT NULL,
+                        created DOUBLE NOT NULL)"""
+
+    def __init__(self, path="geocode_cache.db", ttl=None):
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        self.create()
+
+    def create(self):
+        curs = self.db.cursor()
+        curs.execute(self.create_query)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def key(addr: str):
+        return hashlib.sha1(normalize_address(addr).encode('utf-8')).hexdigest()
+
+    # Returns {address: (lat, lng)} for the addresses that are in the cache
+    def get_many(self, addresses: list):
+        keys = {self.key(addr): addr for addr in addresses}
+        key_list = list(keys)
+        now = time.time()
+        found = {}
+        curs = self.db.cursor()
+        for s in range(0, len(key_list), 500):
+            chunk = key_list[s:s+500]
+            curs.execute(f"SELECT addr_key, lat, lng, created FROM geocode_cache WHERE addr_key IN ({','.join([self.placeholder]*len(chunk))})", chunk)
+            for key, lat, lng, created in curs.fetchall():
+                if self.ttl is None or now-created <= self.ttl:
+                    found[keys[key]] = (lat, lng)
+        return found
+
+    # values is a dictionary of {address: (lat, lng)}
+    def put_many(self, values: dict):
+        if not values:
+            return
+        now = time.time()
+        query = f"REPLACE INTO geocode_cache (addr_key, address, lat, lng, created) VALUES ({','.join([self.placeholder]*5)})"
+        curs = self.db.cursor()
+        curs.executemany(query, [(self.key(addr), normalize_address(addr), lat, lng, now) for addr, (lat, lng) in values.items()])
+        self.db.commit()
+
+
+# The same cache as a table in the scheduler's mysql database, db is an already opened mysql.connector connection
+class MySQLGeocodeCache(GeocodeCache):
+
+    placeholder = '%s'
+
+    def __init__(self, db, ttl=None):
+        self.ttl = ttl
+        self.db = db
+        self.create()
+
+    def close(self):
+        pass
+
+
+# Gives back a len(addresses) x 2 array of (lat, lng), the addresses that are not in the cache are geocoded (at the same time,
+# with the same rate limit as the distance api calls) and saved in the cache, the ones that were found are saved even if another failed
+def locate(addresses: list, cache: GeocodeCache, geocoder, workers=8, per_second=10):
+    found = cache.get_many(addresses)
+    missing = [addr for addr in dict.fromkeys(addresses) if addr not in found]
+    positions, error = fetch_blocks(geocoder.geocode, [(addr,) for addr in missing], workers=workers, per_second=per_second)
+    new_values = {addr: pos for addr, pos in zip(missing, positions) if pos is not None}
+    cache.put_many(new_values)
+    if error is not None:
+        raise error
+    found.update(new_values)
+    return np.array([found[addr] for addr in addresses], dtype=np.float64).reshape(len(addresses), 2)
+
+
+# A quick guess of the driving time between every pair of positions (coords is an n x 2 array of lat, lng):
+# the straight line (haversine) distance, times road_factor because roads are not straight, at speed_kmh
+# The whole n x n matrix is made with numpy in one go, so it takes milliseconds even for thousands of addresses
+# With dests (an m x 2 array) only the n x m matrix from coords to dests is made
+def estimate_matrix(coords, speed_kmh=40.0, road_factor=1.3, dests=None):
+    if dests is None:
+        dests = coords
+    lat = np.radians(coords[:, 0])
+    lng = np.radians(coords[:, 1])
+    to_lat = np.radians(dests[:, 0])
+    to_lng = np.radians(dests[:, 1])
+    dlat = lat[:, None]-to_lat[None, :]
+    dlng = lng[:, None]-to_lng[None, :]
+    a = np.sin(dlat/2)**2+np.cos(lat)[:, None]*np.cos(to_lat)[None, :]*np.sin(dlng/2)**2
+    km = 2*6371.0*np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return np.rint(km*road_factor/speed_kmh*3600).astype(np.int32)
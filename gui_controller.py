@@ -6,6 +6,7 @@ from PySide2.QtUiTools import QUiLoader
 from PySide2 import QtGui, QtCore, QtWidgets
 import pickle
 import algo_v2
+from changes import ChangeSet
 import mysql.connector as mc
 
 SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
@@ -235,6 +236,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     
         self.db_details_ready = False
+        self.changes = ChangeSet()
         self.db_detail_save_button.clicked.connect(self.on_click_db_detail_save_button)
 
         if os.path.exists(os.path.join(SCRIPT_DIRECTORY,"db_info.dat")):
@@ -292,6 +294,7 @@ class MainWindow(QtWidgets.QMainWindow):
                                                     "")
 
             self.CHANGED = True
+            self.changes.everything()
             
             
             self.therapist_view_horizontal_spacer = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
@@ -390,9 +393,12 @@ class MainWindow(QtWidgets.QMainWindow):
     def on_click_dash(self):
         if self.CHANGED:
             self.MainAppStack.setCurrentIndex(1)
-            algo_v2.find_schedule(self.MYSQL_HOST,self.MYSQL_USER,self.MYSQL_PASSWORD,self.MYSQL_DB)
+            # the run renames the schedule tables, so this connection must not hold a read transaction on them
+            self.db_connection.commit()
+            algo_v2.find_schedule(self.MYSQL_HOST,self.MYSQL_USER,self.MYSQL_PASSWORD,self.MYSQL_DB,changes=self.changes)
             self.MainAppStack.setCurrentIndex(0)
             self.CHANGED=False
+            self.changes.clear()
 
         if self.schedule_tab.currentIndex()==0:
             self.on_schedule_tab_change(0)
@@ -1414,36 +1420,36 @@ class MainWindow(QtWidgets.QMainWindow):
             parent_frame = self.ther_sch_frame_mon
             v_layout = self.verticalLayout_31
             self.clear_layout(v_layout)
-            if self.ther_schedule[0] !='' and self.ther_schedule[0] is not None:
-                pnts_list = self.ther_schedule[0].split('-')
+            if self.ther_schedule[0]:
+                pnts_list = self.ther_schedule[0]
                 self.ther_plan_list_maker(parent_frame,v_layout,pnts_list)
         elif tab_index==1:
             parent_frame = self.ther_sch_frame_tue
             v_layout = self.verticalLayout_36
             self.clear_layout(v_layout)
-            if self.ther_schedule[1] !='' and self.ther_schedule[1] is not None:
-                pnts_list = self.ther_schedule[1].split('-')
+            if self.ther_schedule[1]:
+                pnts_list = self.ther_schedule[1]
                 self.ther_plan_list_maker(parent_frame,v_layout,pnts_list)
         elif tab_index==2:
             parent_frame = self.ther_sch_frame_wed
             v_layout = self.verticalLayout_37
             self.clear_layout(v_layout)
-            if self.ther_schedule[2] !='' and self.ther_schedule[2] is not None:
-                pnts_list = self.ther_schedule[2].split('-')
+            if self.ther_schedule[2]:
+                pnts_list = self.ther_schedule[2]
                 self.ther_plan_list_maker(parent_frame,v_layout,pnts_list)
         elif tab_index==3:
             parent_frame = self.ther_sch_frame_thur
             v_layout = self.verticalLayout_38
             self.clear_layout(v_layout)
-            if self.ther_schedule[3] !='' and self.ther_schedule[3] is not None:
-                pnts_list = self.ther_schedule[3].split('-')
+            if self.ther_schedule[3]:
+                pnts_list = self.ther_schedule[3]
                 self.ther_plan_list_maker(parent_frame,v_layout,pnts_list)
         elif tab_index==4:
             parent_frame = self.ther_sch_frame_fri
             v_layout = self.verticalLayout_39
             self.clear_layout(v_layout)
-            if self.ther_schedule[4] !='' and self.ther_schedule[4] is not None:
-                pnts_list = self.ther_schedule[4].split('-')
+            if self.ther_schedule[4]:
+                pnts_list = self.ther_schedule[4]
                 self.ther_plan_list_maker(parent_frame,v_layout,pnts_list)
 
 
@@ -1454,7 +1460,7 @@ class MainWindow(QtWidgets.QMainWindow):
             parent_frame = self.pnt_sch_frame_mon
             v_layout = self.verticalLayout_41
             
-            if self.pnt_schedule[0] !='' and self.pnt_schedule[0] is not None:
+            if self.pnt_schedule[0] is not None:
                 ther_dat = self.get_pnt_plan_details(0)
                 ther_name,ther_apnt_time,ther_prof_name=ther_dat[0],ther_dat[1],ther_dat[2]
                 make_list = True
@@ -1463,7 +1469,7 @@ class MainWindow(QtWidgets.QMainWindow):
             parent_frame = self.pnt_sch_frame_tue
             v_layout = self.verticalLayout_42
            
-            if self.pnt_schedule[1] !='' and self.pnt_schedule[1] is not None:
+            if self.pnt_schedule[1] is not None:
                 ther_dat = self.get_pnt_plan_details(1)
                 ther_name,ther_apnt_time,ther_prof_name=ther_dat[0],ther_dat[1],ther_dat[2]
                 make_list = True
@@ -1473,7 +1479,7 @@ class MainWindow(QtWidgets.QMainWindow):
             parent_frame = self.pnt_sch_frame_wed
             v_layout = self.verticalLayout_44
            
-            if self.pnt_schedule[2] !='' and self.pnt_schedule[2] is not None:
+            if self.pnt_schedule[2] is not None:
                 ther_dat = self.get_pnt_plan_details(2)
                 ther_name,ther_apnt_time,ther_prof_name=ther_dat[0],ther_dat[1],ther_dat[2]
                 make_list = True
@@ -1483,7 +1489,7 @@ class MainWindow(QtWidgets.QMainWindow):
             parent_frame = self.pnt_sch_frame_thur
             v_layout = self.verticalLayout_46
             
-            if self.pnt_schedule[3] !='' and self.pnt_schedule[3] is not None:
+            if self.pnt_schedule[3] is not None:
                 ther_dat = self.get_pnt_plan_details(3)
                 ther_name,ther_apnt_time,ther_prof_name=ther_dat[0],ther_dat[1],ther_dat[2]
                 make_list = True
@@ -1493,7 +1499,7 @@ class MainWindow(QtWidgets.QMainWindow):
             parent_frame = self.pnt_sch_frame_fri
             v_layout = self.verticalLayout_48
             
-            if self.pnt_schedule[4] !='' and self.pnt_schedule[4] is not None:
+            if self.pnt_schedule[4] is not None:
                 ther_dat = self.get_pnt_plan_details(4)
                 ther_name,ther_apnt_time,ther_prof_name=ther_dat[0],ther_dat[1],ther_dat[2]
                 make_list = True
@@ -1519,6 +1525,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.job_id+=1
         self.read_jobsFromDb()
         self.CHANGED=True
+        self.changes.everything()
 
     
     def job_edit_click(self,row_num):
@@ -1545,6 +1552,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.db_connection.commit()
             self.read_jobsFromDb()
         self.CHANGED=True
+        self.changes.everything()
 
 
     def change_job_stackindex(self):
@@ -1558,6 +1566,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.db_cursor.execute("UPDATE job_ids SET ID = %s WHERE ID = %s",(new_id,row[0]))
         self.db_connection.commit()
         self.CHANGED=True
+        self.changes.everything()
 
         self.read_jobsFromDb()
 
@@ -1617,6 +1626,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.thur_check.setChecked(False)
             self.fri_check.setChecked(False)
             self.CHANGED=True
+            self.changes.therapist(ther_id)
 
 
     def add_patient_button_click(self):
@@ -1666,6 +1676,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.thur_check_patient.setChecked(False)
             self.fri_check_patient.setChecked(False)
             self.CHANGED=True
+            self.changes.insert(pat_id)
 
 
     def view_plan_button_click(self,ther_id):
@@ -1673,8 +1684,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.db_cursor.execute("SELECT Therapist from therapists WHERE ID=%s",(ther_id,))
         ther_name = self.db_cursor.fetchall()[0][0]
         self.ther_plan_name_label.setText(ther_name)
-        self.db_cursor.execute("SELECT Mo,Tu,We,Th,Fr FROM therapist_schedule WHERE ID=%s",(ther_id,))
-        self.ther_schedule = self.db_cursor.fetchall()[0]
+        # the whole week of the therapist in one query (see appointments.py), a list of (number, name, address) for every day
+        self.db_cursor.execute("""SELECT a.day, a.sequence, p.Patient, p.Patient_Adress FROM appointments a
+                                  JOIN patients p ON p.ID = a.patient_id
+                                  WHERE a.therapist_id=%s ORDER BY a.day, a.sequence""",(ther_id,))
+        days = ['Mo','Tu','We','Th','Fr']
+        self.ther_schedule = [[] for day in days]
+        for day,sequence,pnt_name,pnt_address in self.db_cursor.fetchall():
+            self.ther_schedule[days.index(day)].append((str(sequence),pnt_name,pnt_address))
+        # ends the read transaction, an open one would keep the metadata lock on appointments and make a run wait (see publish.py)
+        self.db_connection.commit()
         self.ther_plan_tabs.setCurrentIndex(0)
         self.on_ther_plan_day_tab_change(0)
     
@@ -1683,8 +1702,17 @@ class MainWindow(QtWidgets.QMainWindow):
         self.db_cursor.execute("SELECT Patient from patients WHERE ID=%s",(pnt_id,))
         patient_name = self.db_cursor.fetchall()[0][0]
         self.pnt_plan_name_label.setText(patient_name)
-        self.db_cursor.execute("SELECT Mo,Tu,We,Th,Fr FROM patient_schedule WHERE ID=%s",(pnt_id,))
-        self.pnt_schedule = self.db_cursor.fetchall()[0]
+        # the whole week of the patient in one query, (therapist, time, profession) for every day or None if there is no visit
+        self.db_cursor.execute("""SELECT a.day, a.start_seconds, t.Therapist, j.name FROM appointments a
+                                  JOIN therapists t ON t.ID = a.therapist_id
+                                  JOIN job_ids j ON j.ID = t.Profession
+                                  WHERE a.patient_id=%s""",(pnt_id,))
+        days = ['Mo','Tu','We','Th','Fr']
+        self.pnt_schedule = [None for day in days]
+        for day,start_seconds,ther_name,ther_prof_name in self.db_cursor.fetchall():
+            ther_apnt_time = f"{start_seconds//3600}:{start_seconds%3600//60:02d}"
+            self.pnt_schedule[days.index(day)] = (ther_name,ther_apnt_time,ther_prof_name)
+        self.db_connection.commit()
         self.pnt_plan_tabs.setCurrentIndex(0)
         self.on_pnt_plan_day_tab_change(0)
 
@@ -1784,6 +1812,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.db_cursor.execute("UPDATE therapist_availability SET Therapist=%s,Days=%s,Time_From=%s,Time_To=%s WHERE ID=%s",(ther_name,avail_days,from_time,to_time,ther_id))
             self.db_connection.commit()
             self.CHANGED=True
+            self.changes.therapist(ther_id)
         
 
     def on_ther_delete_click(self,ther_id):
@@ -1803,6 +1832,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.db_connection.commit()
         self.on_thrapist_tab_change(1)
         self.CHANGED=True
+        self.changes.therapist(ther_id)
 
 
     def on_patient_edit_click(self,pnt_id,pnt_name,pnt_address,pnt_prof,avail_days):
@@ -1880,6 +1910,7 @@ class MainWindow(QtWidgets.QMainWindow):
             
         self.db_connection.commit()
         self.CHANGED=True
+        self.changes.patient(pnt_id)
 
             
 
@@ -1900,6 +1931,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.db_connection.commit()
         self.on_patient_tab_change(1)
         self.CHANGED=True
+        self.changes.cancel(pnt_id)
 
 
     def on_click_back_add_button_edit_patient(self):
@@ -1926,13 +1958,8 @@ class MainWindow(QtWidgets.QMainWindow):
                 
     
     def ther_plan_list_maker(self,parent_frame,v_layout,pnts_list):
-        for pnt_id in pnts_list:
-            self.db_cursor.execute("SELECT Patient,Patient_Adress FROM patients WHERE ID = %s",(pnt_id,))
-            pnt_dat = self.db_cursor.fetchall()
-            pnt_no = pnts_list.index(pnt_id)+1
-            pnt_name = pnt_dat[0][0]
-            pnt_address = pnt_dat[0][1]
-            pnt = self.create_ther_plan_list(parent_frame,str(pnt_no),pnt_name,pnt_address)
+        for pnt_no,pnt_name,pnt_address in pnts_list:
+            pnt = self.create_ther_plan_list(parent_frame,pnt_no,pnt_name,pnt_address)
             v_layout.addWidget(pnt)
 
         verticalSpacer_3 = QtWidgets.QSpacerItem(20, 88, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
@@ -1940,17 +1967,7 @@ class MainWindow(QtWidgets.QMainWindow):
     
     def get_pnt_plan_details(self,index):
             
-            ther_and_time = self.pnt_schedule[index].split('-')
-            ther_id = ther_and_time[0]
-            temp_time = ther_and_time[1].split(":")
-            ther_apnt_time = temp_time[0]+":"+temp_time[1]
-
-            self.db_cursor.execute("SELECT Therapist,Profession FROM therapists WHERE ID=%s ",(ther_id,))
-            ther_dat = self.db_cursor.fetchall()
-            ther_name = ther_dat[0][0]
-            ther_prof_id = ther_dat[0][1]
-            self.db_cursor.execute("SELECT name FROM job_ids WHERE ID=%s",(ther_prof_id,))
-            ther_prof_name = self.db_cursor.fetchall()[0][0]
+            ther_name,ther_apnt_time,ther_prof_name = self.pnt_schedule[index]
 
             return ther_name,ther_apnt_time,ther_prof_name
 
@@ -0,0 +1,85 @@
+import time
+
+
+# The new schedule is written into shadow tables (name_new, made LIKE the real ones) next to the tables the gui reads, and then
+# all of them are swapped in with one RENAME TABLE, which mysql does atomically for every table in it. A reader sees either the
+# whole old schedule or the whole new one, never an empty or half written table, and it never has to wait for a run
+# The generation before is kept as name_old, so it can be put back with rollback_tables
+# A RENAME TABLE (and DROP TABLE) has to wait for every open transaction that read one of its tables, by default for
+# lock_wait_timeout which is a year, so it only waits a few seconds at a time here (see rename_tables)
+# diff_tables instead only writes the rows that are not the same as the stored ones, in one transaction
+
+
+# mysql's error number for "Lock wait timeout exceeded"
+LOCK_WAIT_TIMEOUT = 1205
+
+
+# Runs the DROP TABLE / RENAME TABLE statements with the session's lock_wait_timeout set to lock_wait seconds, a statement
+# that times out (a reader still has its transaction open) is tried again up to retries times, then the error is raised
+# The RENAME TABLE is all or nothing, so when it fails the tables are still the ones from before
+def rename_tables(db, statements: list, lock_wait=5, retries=3):
+    curs = db.cursor()
+    curs.execute(f"SET SESSION lock_wait_timeout = {int(lock_wait)}")
+    try:
+        for statement in statements:
+            attempt = 0
+            while True:
+                try:
+                    curs.execute(statement)
+                    break
+                except Exception as e:
+                    if getattr(e, 'errno', None) != LOCK_WAIT_TIMEOUT or attempt >= retries:
+                        raise
+                    print(f"the tables are in use, trying {' '.join(statement.split()[:2])} again")
+                    time.sleep(1)
+                    attempt += 1
+    finally:
+        curs.execute("SET SESSION lock_wait_timeout = DEFAULT")
+        curs.close()
+
+
+# tables is {name: (columns, rows)}, the rows are the whole new content of the table
+def publish_tables(db, tables: dict):
+    curs = db.cursor()
+    for name, (columns, rows) in tables.items():
+        curs.execute(f"DROP TABLE IF EXISTS {name}_new")
+        curs.execute(f"CREATE TABLE {name}_new LIKE {name}")
+        query = f"INSERT INTO {name}_new ({', '.join(columns)}) VALUES ({','.join(['%s']*len(columns))})"
+        curs.executemany(query, rows)
+    db.commit()
+    curs.close()
+
+    rename_tables(db, [f"DROP TABLE IF EXISTS {name}_old" for name in tables]
+                  + ["RENAME TABLE "+", ".join(f"{name} TO {name}_old, {name}_new TO {name}" for name in tables)])
+
+
+# Swaps the kept generation (name_old) and the current one, again in one RENAME TABLE, so calling it twice undoes it
+def rollback_tables(db, names: list):
+    rename_tables(db, ["RENAME TABLE "+", ".join(f"{name} TO {name}_swap, {name}_old TO {name}, {name}_swap TO {name}_old" for name in names)])
+
+
+# Reads the stored rows of every table and only writes the difference to the new ones: an INSERT for a new ID, an UPDATE for a
+# row that changed and a DELETE for an ID that is gone, each kind as one executemany, and one commit for all the tables
+# A row is found by its first keys[name] columns (by default just the first one, the ID). Gives back {name: (inserted, updated, deleted)}
+def diff_tables(db, tables: dict, keys=None):
+    curs = db.cursor()
+    counts = {}
+    for name, (columns, rows) in tables.items():
+        k = (keys or {}).get(name, 1)
+        where = ' AND '.join(column+'=%s' for column in columns[:k])
+        curs.execute(f"SELECT {', '.join(columns)} FROM {name}")
+        stored = {tuple(row[:k]): tuple(row) for row in curs.fetchall()}
+        new = {tuple(row[:k]): tuple(row) for row in rows}
+
+        inserted = [row for key, row in new.items() if key not in stored]
+        updated = [row[k:]+row[:k] for key, row in new.items() if key in stored and stored[key] != row]
+        deleted = [key for key in stored if key not in new]
+
+        curs.executemany(f"DELETE FROM {name} WHERE {where}", deleted)
+        curs.executemany(f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({','.join(['%s']*len(columns))})", inserted)
+        if len(columns) > k:
+            curs.executemany(f"UPDATE {name} SET {', '.join(column+'=%s' for column in columns[k:])} WHERE {where}", updated)
+        counts[name] = (len(inserted), len(updated), len(deleted))
+    db.commit()
+    curs.close()
+    return counts
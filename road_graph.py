@@ -0,0 +1,390 @@
+import csv
+import heapq
+import math
+import struct
+import sys
+from array import array
+
+import numpy as np
+
+from distance_provider import DistanceProvider
+from travel_cache import normalize_address
+
+
+# A road graph kept in compact arrays (CSR layout): the roads leaving node u are head[first_out[u]:first_out[u+1]]
+# and the travel time of each of them in seconds is in weight at the same place
+# ids are the node ids used in the source file (for example the osm node ids), inside the graph the nodes are 0..n-1
+class RoadGraph:
+
+    magic = b'RDGR'
+    version = 1
+
+    def __init__(self, ids, lat, lng, first_out, head, weight):
+        self.ids = ids
+        self.lat = lat
+        self.lng = lng
+        self.first_out = first_out
+        self.head = head
+        self.weight = weight
+        self.index = {node_id: u for u, node_id in enumerate(ids)}
+        self.ch = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    # The edge list is a text file with one road per line:
+    #   <from id> <to id> <seconds>       a road that can be driven both ways (unless bidirectional is False)
+    #   a <from id> <to id> <seconds>     a one way road
+    #   v <id> <lat> <lng>                the position of a node, only needed to find the nearest node to a geocoded address
+    # empty lines and lines starting with # are skipped
+    @classmethod
+    def from_edge_list(cls, path, bidirectional=True):
+        coords = {}
+        edges = {}
+        ids = {}
+
+        def node(node_id):
+            if node_id not in ids:
+                ids[node_id] = len(ids)
+            return ids[node_id]
+
+        def add_edge(u, v, seconds):
+            if u != v and seconds < edges.get((u, v), math.inf):
+                edges[(u, v)] = seconds
+
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if not parts or parts[0].startswith('#'):
+                    continue
+                if parts[0] == 'v':
+                    coords[node(int(parts[1]))] = (float(parts[2]), float(parts[3]))
+                elif parts[0] == 'a':
+                    add_edge(node(int(parts[1])), node(int(parts[2])), float(parts[3]))
+                else:
+                    u, v, seconds = node(int(parts[0])), node(int(parts[1])), float(parts[2])
+                    add_edge(u, v, seconds)
+                    if bidirectional:
+                        add_edge(v, u, seconds)
+
+        n = len(ids)
+        lat = array('d', [coords.get(u, (math.nan, math.nan))[0] for u in range(n)])
+        lng = array('d', [coords.get(u, (math.nan, math.nan))[1] for u in range(n)])
+        first_out, head, weight = to_csr(n, edges)
+        return cls(array('q', ids), lat, lng, first_out, head, weight)
+
+    # The binary file is the arrays one after the other (little endian) after a small header, so loading it is just reading them back
+    # If the contraction hierarchy was built it is saved too, so it does not have to be made again on every start
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<4sIIIB', self.magic, self.version, len(self), len(self.head), self.ch is not None))
+            for arr in (self.ids, self.lat, self.lng, self.first_out, self.head, self.weight):
+                write_array(f, arr)
+            if self.ch is not None:
+                for arr in self.ch.arrays():
+                    write_array(f, arr)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, n, m, has_ch = struct.unpack('<4sIIIB', f.read(struct.calcsize('<4sIIIB')))
+            if magic != cls.magic or version != cls.version:
+                raise ValueError(f"{path} is not a road graph file")
+            graph = cls(read_array(f, 'q', n), read_array(f, 'd', n), read_array(f, 'd', n),
+                        read_array(f, 'I', n+1), read_array(f, 'I', m), read_array(f, 'f', m))
+            if has_ch:
+                graph.ch = ContractionHierarchy.read(f, n)
+        return graph
+
+    def contract(self, witness_limit=60):
+        self.ch = ContractionHierarchy.build(self, witness_limit)
+        return self.ch
+
+    # The travel time from every source node to every target node (inf when there is no road between them)
+    def many_to_many(self, sources: list, targets: list):
+        if self.ch is not None:
+            return self.ch.many_to_many(sources, targets)
+        return [dijkstra_to(self.first_out, self.head, self.weight, s, targets) for s in sources]
+
+    # The node nearest to (lat, lng), the longitude difference is made shorter by cos(lat) like on the map and the nodes without
+    # a position (nan) are skipped. lat and lng are looked at as numpy arrays (no copy), so every address is one pass in numpy
+    # instead of a python loop over all the nodes
+    def nearest_node(self, lat, lng):
+        if len(self) == 0:
+            raise ValueError("the road graph has no node positions")
+        lats = np.frombuffer(self.lat, dtype=np.float64)
+        lngs = np.frombuffer(self.lng, dtype=np.float64)
+        d = (lats-lat)**2+((lngs-lng)*math.cos(math.radians(lat)))**2
+        if np.isnan(d).all():
+            raise ValueError("the road graph has no node positions")
+        return int(np.nanargmin(d))
+
+
+def to_csr(n, edges: dict):
+    counts = [0]*(n+1)
+    for u, _ in edges:
+        counts[u+1] += 1
+    for u in range(n):
+        counts[u+1] += counts[u]
+    first_out = array('I', counts)
+    head = array('I', [0]*len(edges))
+    weight = array('f', [0.0]*len(edges))
+    fill = list(counts[:n])
+    for (u, v), seconds in sorted(edges.items()):
+        head[fill[u]] = v
+        weight[fill[u]] = seconds
+        fill[u] += 1
+    return first_out, head, weight
+
+
+def write_array(f, arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    f.write(arr.tobytes())
+
+
+def read_array(f, typecode, length):
+    arr = array(typecode)
+    arr.frombytes(f.read(arr.itemsize*length))
+    if len(arr) != length:
+        raise ValueError("the road graph file is cut short")
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+# Plain dijkstra from source, it stops as soon as all the targets are settled
+def dijkstra_to(first_out, head, weight, source, targets):
+    left = set(targets)
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    done = set()
+    while heap and left:
+        d, u = heapq.heappop(heap)
+        if u in done:
+            continue
+        done.add(u)
+        left.discard(u)
+        for e in range(first_out[u], first_out[u+1]):
+            v = head[e]
+            nd = d+weight[e]
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return [dist.get(t, math.inf) for t in targets]
+
+
+# Full dijkstra over a (small) search graph, gives back {node: distance} for every node it reaches
+def search_space(first_out, head, weight, source):
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    done = {}
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in done:
+            continue
+        done[u] = d
+        for e in range(first_out[u], first_out[u+1]):
+            v = head[e]
+            nd = d+weight[e]
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return done
+
+
+# Contraction hierarchy: the nodes are removed one by one (least important first) and when a shortest path went through the removed
+# node a shortcut road is added around it. After that every shortest path can be found by only going "up" (to more important nodes)
+# from both ends, and those upward searches only look at a few hundred nodes even on a big road network
+# up is the graph of roads going up from a node, down has for every node the roads that come down into it (reversed, for the
+# backward search from the targets)
+class ContractionHierarchy:
+
+    def __init__(self, rank, up, down):
+        self.rank = rank
+        self.up = up
+        self.down = down
+
+    @classmethod
+    def build(cls, graph: RoadGraph, witness_limit=60):
+        n = len(graph)
+        out = [dict() for _ in range(n)]
+        inn = [dict() for _ in range(n)]
+        for u in range(n):
+            for e in range(graph.first_out[u], graph.first_out[u+1]):
+                v = graph.head[e]
+                out[u][v] = graph.weight[e]
+                inn[v][u] = graph.weight[e]
+
+        contracted = [False]*n
+        removed_neighbours = [0]*n
+        rank = array('I', [0]*n)
+
+        # Looks for a path from source to the targets that does not use skip and is not longer than limit,
+        # only witness_limit nodes are settled so a witness might be missed, then an extra (but correct) shortcut is added
+        def witness_search(source, skip, limit):
+            dist = {source: 0.0}
+            heap = [(0.0, source)]
+            settled = 0
+            while heap and settled < witness_limit:
+                d, u = heapq.heappop(heap)
+                if d > limit:
+                    break
+                if d > dist.get(u, math.inf):
+                    continue
+                settled += 1
+                for v, w in out[u].items():
+                    if v == skip or contracted[v]:
+                        continue
+                    nd = d+w
+                    if nd < dist.get(v, math.inf):
+                        dist[v] = nd
+                        heapq.heappush(heap, (nd, v))
+            return dist
+
+        def shortcuts(v):
+            ins = [(u, w) for u, w in inn[v].items() if not contracted[u]]
+            outs = [(x, w) for x, w in out[v].items() if not contracted[x]]
+            found = []
+            if not ins or not outs:
+                return found, ins, outs
+            max_out = max(w for _, w in outs)
+            for u, w_in in ins:
+                dist = witness_search(u, v, w_in+max_out)
+                for x, w_out in outs:
+                    if x != u and dist.get(x, math.inf) > w_in+w_out:
+                        found.append((u, x, w_in+w_out))
+            return found, ins, outs
+
+        # The node that adds the fewest shortcuts compared to the roads it removes is contracted first
+        def priority(found, ins, outs, v):
+            return len(found)-len(ins)-len(outs)+removed_neighbours[v]
+
+        heap = [(priority(*shortcuts(v), v), v) for v in range(n)]
+        heapq.heapify(heap)
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if contracted[v]:
+                continue
+            # The priorities change while the graph is contracted, so it is checked again before the node is really removed
+            found, ins, outs = shortcuts(v)
+            new_priority = priority(found, ins, outs, v)
+            if heap and new_priority > heap[0][0]:
+                heapq.heappush(heap, (new_priority, v))
+                continue
+
+            for u, x, w in found:
+                if w < out[u].get(x, math.inf):
+                    out[u][x] = w
+                    inn[x][u] = w
+            contracted[v] = True
+            rank[v] = order
+            order += 1
+            for u, _ in ins+outs:
+                removed_neighbours[u] += 1
+
+        up_edges = {}
+        down_edges = {}
+        for u in range(n):
+            for v, w in out[u].items():
+                if rank[v] > rank[u]:
+                    up_edges[(u, v)] = w
+                else:
+                    down_edges[(v, u)] = w
+        return cls(rank, to_csr(n, up_edges), to_csr(n, down_edges))
+
+    def arrays(self):
+        return (self.rank,)+self.up+self.down
+
+    @classmethod
+    def read(cls, f, n):
+        rank = read_array(f, 'I', n)
+        graphs = []
+        for _ in range(2):
+            first_out = read_array(f, 'I', n+1)
+            head = read_array(f, 'I', first_out[n])
+            weight = read_array(f, 'f', first_out[n])
+            graphs.append((first_out, head, weight))
+        return cls(rank, graphs[0], graphs[1])
+
+    # Bucket based many to many: first an upward search is made backwards from every target and every node it reaches gets
+    # a note (target, distance) in its bucket, then an upward search is made from every source and the buckets of the nodes
+    # it reaches give the distance to the targets. That is len(sources)+len(targets) small searches instead of a full dijkstra for each pair
+    def many_to_many(self, sources: list, targets: list):
+        buckets = {}
+        for j, t in enumerate(targets):
+            for x, d in search_space(*self.down, t).items():
+                buckets.setdefault(x, []).append((j, d))
+
+        result = []
+        for s in sources:
+            row = [math.inf]*len(targets)
+            for x, d in search_space(*self.up, s).items():
+                for j, d2 in buckets.get(x, ()):
+                    if d+d2 < row[j]:
+                        row[j] = d+d2
+            result.append(row)
+        return result
+
+
+# Distance provider that answers from a local road graph instead of an api
+# The addresses have to be matched to nodes of the graph, either with address_nodes (a dictionary or a csv file of address,node id)
+# or with locate, a function that gives (lat, lng) for an address, then the nearest node of the graph is used
+# There is no limit on the size of one call, so build_matrix asks for big blocks at once
+class RoadGraphProvider(DistanceProvider):
+
+    max_side = 1000
+    max_elements = 1000*1000
+
+    def __init__(self, path, address_nodes=None, locate=None, contract=True):
+        if path.endswith('.txt') or path.endswith('.edges'):
+            self.graph = RoadGraph.from_edge_list(path)
+        else:
+            self.graph = RoadGraph.load(path)
+        if contract and self.graph.ch is None:
+            self.graph.contract()
+
+        self.address_nodes = {}
+        if isinstance(address_nodes, str):
+            with open(address_nodes, newline='') as f:
+                for row in csv.reader(f):
+                    if len(row) >= 2:
+                        self.address_nodes[normalize_address(row[0])] = int(row[1])
+        elif address_nodes:
+            for addr, node_id in address_nodes.items():
+                self.address_nodes[normalize_address(addr)] = node_id
+        self.locate = locate
+        self.nodes = {}
+
+    def node_for(self, addr: str):
+        key = normalize_address(addr)
+        if key not in self.nodes:
+            if key in self.address_nodes:
+                self.nodes[key] = self.graph.index[self.address_nodes[key]]
+            elif self.locate is not None:
+                lat, lng = self.locate(addr)
+                self.nodes[key] = self.graph.nearest_node(lat, lng)
+            else:
+                raise KeyError(f"no road graph node for the address {addr!r}")
+        return self.nodes[key]
+
+    def matrix(self, origins: list, destinations: list):
+        times = self.graph.many_to_many([self.node_for(o) for o in origins], [self.node_for(d) for d in destinations])
+        matrix = []
+        for o, row in zip(origins, times):
+            for d, seconds in zip(destinations, row):
+                if seconds == math.inf:
+                    raise ValueError(f"there is no road from {o!r} to {d!r} in the road graph")
+            matrix.append([int(round(seconds)) for seconds in row])
+        return matrix
+
+
+if __name__ == '__main__':
+    # python road_graph.py edges.txt graph.bin
+    # reads an edge list, builds the contraction hierarchy and saves both in the binary format
+    road_graph = RoadGraph.from_edge_list(sys.argv[1])
+    road_graph.contract()
+    road_graph.save(sys.argv[2])
+    print(f"{len(road_graph)} nodes, {len(road_graph.head)} roads, {len(road_graph.ch.up[1])+len(road_graph.ch.down[1])} ch edges")
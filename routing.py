@@ -0,0 +1,377 @@
+import itertools
+import random
+import time
+
+import numpy as np
+
+from distance_matrix import INF
+
+
+# The "nearest house" route of one therapist for one day
+# mat is the therapist's matrix (row and column 0 is the therapist, the others are the patients in pids order) and candidates
+# are the columns of the patients that can be visited this day. mat is only read, the columns already driven to this day are kept in
+# a boolean mask (consumed), so every day starts from the whole matrix again without copying it. A mask can be given as consumed to
+# carry it over several calls. From where the therapist is, the nearest candidate is taken (the one with the smallest column when
+# two are equally near), if the day is not over after driving there and the 90 minute visit (visit_time) and can_visit(column)
+# allows it, the patient is visited. Either way the therapist goes on from there.
+# Gives back the visits as (column, start of the visit in seconds from the start of the day), the legs driven as (from, to) columns
+# and the candidates that were not visited
+def nearest_neighbour_day(mat, candidates: list, time_diff, visit_time=90*60, can_visit=None, consumed=None):
+    if consumed is None:
+        consumed = np.zeros(len(mat), dtype=bool)
+    left = np.array(candidates, dtype=np.intp)
+    stops = []
+    legs = []
+    time_used = 0
+    here = 0
+    while len(left):
+        vals = np.where(consumed[left], INF, mat[here, left])
+        nearest = int(vals.min())
+        if nearest == INF:
+            break
+        time_used += visit_time+nearest
+        if time_used > time_diff:
+            break
+
+        col = int(left[vals == nearest].min())
+        legs.append((here, col))
+        if can_visit is None or can_visit(col):
+            stops.append((col, time_used-visit_time))
+            left = left[left != col]
+
+        here = col
+        consumed[col] = True
+
+    return stops, legs, left.tolist()
+
+
+# The start of every visit of a day's route (the columns in the order they are visited, the therapist starts at column 0)
+# and the legs driven, in the same form as nearest_neighbour_day gives them back
+def route_times(mat, route: list, visit_time=90*60):
+    stops = []
+    legs = []
+    time_used = 0
+    here = 0
+    for col in route:
+        time_used += int(mat[here, col])
+        stops.append((col, time_used))
+        legs.append((here, col))
+        time_used += visit_time
+        here = col
+    return stops, legs
+
+
+# Driving time of a route plus the visits, this is what has to fit into the therapist's day
+def route_duration(d: list, path: list, visit_time=90*60):
+    drive = sum(d[a][b] for a, b in zip(path, path[1:]))
+    return drive+visit_time*(len(path)-1)
+
+
+# 2-opt: turns the part path[i..j] around, which takes out the legs a-b and c-e and puts in a-c and b-e
+# The matrix is the same in both directions (see place_block) so the legs inside the part cost the same after turning it,
+# and every move is checked in O(1). The route does not go back home, so the last part has no e
+def two_opt(d: list, path: list):
+    k = len(path)
+    for i in range(1, k-1):
+        a = path[i-1]
+        b = path[i]
+        for j in range(i+1, k):
+            c = path[j]
+            delta = d[a][c]-d[a][b]
+            if j+1 < k:
+                e = path[j+1]
+                delta += d[b][e]-d[c][e]
+            if delta < 0:
+                path[i:j+1] = path[i:j+1][::-1]
+                return True
+    return False
+
+
+# Or-opt: takes out a part of 1 to 3 visits in a row (one visit is a relocate move) and puts it between two other visits
+# (or at the end), the right way round or turned around, whichever is shorter. Also checked in O(1) per move
+def or_opt(d: list, path: list, max_len=3):
+    k = len(path)
+    for length in range(1, max_len+1):
+        for i in range(1, k-length+1):
+            first = path[i]
+            last = path[i+length-1]
+            prev = path[i-1]
+            gain = d[prev][first]
+            if i+length < k:
+                nxt = path[i+length]
+                gain += d[last][nxt]-d[prev][nxt]
+
+            rest = path[:i]+path[i+length:]
+            for j in range(1, len(rest)+1):
+                x = rest[j-1]
+                y = rest[j] if j < len(rest) else None
+                cost = d[x][first] if y is None else d[x][first]+d[last][y]-d[x][y]
+                cost_turned = d[x][last] if y is None else d[x][last]+d[first][y]-d[x][y]
+                if j != i and cost-gain < 0:
+                    path[:] = rest[:j]+path[i:i+length]+rest[j:]
+                    return True
+                if length > 1 and cost_turned-gain < 0:
+                    path[:] = rest[:j]+path[i:i+length][::-1]+rest[j:]
+                    return True
+    return False
+
+
+# Cheapest insertion of the candidates that are not in the route yet: the candidate and place that add the least time are taken
+# as long as the day still has time for them
+def insert_candidates(d: list, path: list, free: list, time_diff, visit_time=90*60):
+    duration = route_duration(d, path, visit_time)
+    while free:
+        best = None
+        for p in free:
+            for j in range(1, len(path)+1):
+                x = path[j-1]
+                cost = d[x][p] if j == len(path) else d[x][p]+d[p][path[j]]-d[x][path[j]]
+                if best is None or cost < best[0]:
+                    best = (cost, p, j)
+        cost, p, j = best
+        if duration+cost+visit_time > time_diff:
+            return
+        path.insert(j, p)
+        free.remove(p)
+        duration += cost+visit_time
+
+
+# About how many steps of work (see improve_route) are done in a second
+IMPROVE_WORK_PER_SECOND = 3000000
+
+
+# The improvement stage after nearest_neighbour_day: the order of the day's visits is made shorter with 2-opt and or-opt moves,
+# then the time that was won is used to visit more of the candidates (the ones can_visit allows) and the new route is made
+# shorter again. It stops when no move makes the route shorter or when time_budget*IMPROVE_WORK_PER_SECOND steps of work are done
+# (every pass counts len(nodes)**2). The work is counted instead of looking at the clock, so the same day always gets the same route,
+# however loaded the machine is and in whichever process it runs
+# route are the columns in the order they are visited, the new order is given back
+def improve_route(mat, route: list, candidates: list, time_diff, visit_time=90*60, can_visit=None, time_budget=0.05):
+    nodes = [0]+list(route)+[col for col in candidates if col not in route and (can_visit is None or can_visit(col))]
+    d = mat[np.ix_(nodes, nodes)].astype(np.int64).tolist()
+    path = list(range(len(route)+1))
+    free = list(range(len(route)+1, len(nodes)))
+
+    budget = time_budget*IMPROVE_WORK_PER_SECOND
+    work = 0
+    while work < budget:
+        work += len(nodes)**2
+        if two_opt(d, path) or or_opt(d, path):
+            continue
+        size = len(path)
+        insert_candidates(d, path, free, time_diff, visit_time)
+        if len(path) == size:
+            break
+
+    return [nodes[p] for p in path[1:]]
+
+
+# Exact version of a day for a few candidates (Held-Karp): best[mask, j] is the shortest driving time from the therapist through
+# the candidates in mask (a bitmask over candidates) ending at candidate j, and every mask is worked out from the smaller ones
+# (which are kept in the table, so no sub route is worked out twice). The route that visits the most candidates and still fits into
+# time_diff is taken, if there are more of them the one with the least driving. Only the candidates can_visit allows are used.
+# It takes O(2^k k^2) for k candidates, so it is only meant for small days (see exact_size in find_schedule)
+def held_karp(mat, candidates: list, time_diff, visit_time=90*60, can_visit=None):
+    cols = [col for col in candidates if can_visit is None or can_visit(col)]
+    k = len(cols)
+    if k == 0:
+        return []
+    nodes = [0]+cols
+    d = mat[np.ix_(nodes, nodes)].astype(np.int64)
+    between = d[1:, 1:]
+    none = np.iinfo(np.int64).max//2
+
+    best = np.full((1 << k, k), none, dtype=np.int64)
+    parent = np.full((1 << k, k), -1, dtype=np.int8)
+    ends = np.arange(k)
+    best[1 << ends, ends] = d[0, 1:]
+    bits = (np.arange(1 << k)[:, None] >> ends) & 1
+
+    for mask in range(1, 1 << k):
+        row = best[mask]
+        if row.min() >= none:
+            continue
+        js = ends[bits[mask] == 0]
+        if not len(js):
+            continue
+        ways = row[:, None]+between[:, js]
+        came = ways.argmin(axis=0)
+        vals = ways[came, np.arange(len(js))]
+        targets = mask | (1 << js)
+        better = vals < best[targets, js]
+        best[targets[better], js[better]] = vals[better]
+        parent[targets[better], js[better]] = came[better]
+
+    visits = bits.sum(axis=1)
+    drive = best.min(axis=1)
+    fits = drive+visits*visit_time <= time_diff
+    fits[0] = False
+    if not fits.any():
+        return []
+    most = visits[fits].max()
+    masks = np.flatnonzero(fits & (visits == most))
+    mask = int(masks[drive[masks].argmin()])
+
+    route = []
+    j = int(best[mask].argmin())
+    while j >= 0:
+        route.append(cols[j])
+        mask, j = mask ^ (1 << j), int(parent[mask, j])
+    return route[::-1]
+
+
+# Driving time of a route (without the visits)
+def route_drive(mat, route: list):
+    return sum(int(mat[a, b]) for a, b in zip([0]+list(route), route))
+
+
+# Only the cheapest insertion part of improve_route: the candidates that are not in the route yet (and that can_visit allows)
+# are put in where they add the least time, as long as the day has time for them. The visits already in the route stay in their order
+def fill_route(mat, route: list, candidates: list, time_diff, visit_time=90*60, can_visit=None):
+    nodes = [0]+list(route)+[col for col in candidates if col not in route and (can_visit is None or can_visit(col))]
+    d = mat[np.ix_(nodes, nodes)].astype(np.int64).tolist()
+    path = list(range(len(route)+1))
+    insert_candidates(d, path, list(range(len(route)+1, len(nodes))), time_diff, visit_time)
+    return [nodes[p] for p in path[1:]]
+
+
+# The week of one therapist on its own, for the parallel mode of plan_routes in algo_v2 (it runs in another process, so it only
+# gets plain arguments). days has the candidate columns of every day, a patient visited on one day is not a candidate on the
+# later days, like in plan_routes. Gives back the route (columns in the order they are visited) of every day
+def solve_therapist(mat, days: list, time_diff, visit_time=90*60, improve_seconds=0.05, exact_size=10):
+    chosen = set()
+    routes = []
+    for candidates in days:
+        candidates = [col for col in candidates if col not in chosen]
+        if 0 < len(candidates) <= exact_size:
+            route = held_karp(mat, candidates, time_diff, visit_time)
+        else:
+            stops, legs, left = nearest_neighbour_day(mat, candidates, time_diff, visit_time)
+            route = [col for col, start in stops]
+            if improve_seconds > 0:
+                route = improve_route(mat, route, candidates, time_diff, visit_time, None, improve_seconds)
+        chosen.update(route)
+        routes.append(route)
+    return routes
+
+
+# This is the old list based version of nearest_neighbour_day (pids.index for every candidate, mat[mat_r].index(min) for every step
+# and a whole column set to float('inf') after it), it is only kept to check and benchmark the new one against, see the bottom of this file
+def nearest_neighbour_day_lists(mat: list, candidates: list, time_diff, visit_time=90*60, can_visit=None):
+    pids = list(range(len(mat)))
+    p_day_list = list(candidates)
+    stops = []
+    legs = []
+    time_used = 0
+    mat_r = 0
+    while len(p_day_list) > 0:
+        min = float('inf')
+        for p in p_day_list:
+            mat_c = pids.index(p)
+            if mat[mat_r][mat_c] < min:
+                min = mat[mat_r][mat_c]
+
+        time_used += visit_time+min
+        if time_used > time_diff:
+            break
+        ele = pids[mat[mat_r].index(min)]
+        legs.append((mat_r, ele))
+        if can_visit is None or can_visit(ele):
+            stops.append((ele, time_used-visit_time))
+            p_day_list.remove(ele)
+
+        mat_r = mat[mat_r].index(min)
+        for row in mat:
+            row[mat_r] = float('inf')
+
+    return stops, legs, p_day_list
+
+
+# Runs both versions on random matrices (with distinct travel times, the old version breaks on some ties) for a whole week of
+# days sharing the same matrix (the old version writes into it, so the new one is given one mask for the week), checks that they give the same routes and prints how long each one took
+def benchmark_nearest_neighbour(sizes=(20, 50, 100, 200, 400), days=5, seed=0):
+    rnd = random.Random(seed)
+    for n in sizes:
+        values = rnd.sample(range(200, 200+n*n*2), n*n)
+        mat = np.array(values, dtype=np.int32).reshape(n, n)
+        np.fill_diagonal(mat, 0)
+        week = [sorted(rnd.sample(range(1, n), (n-1)*2//3)) for _ in range(days)]
+        time_diff = 60*60*60
+        rejected = set(rnd.sample(range(1, n), n//10))
+
+        def can_visit(col):
+            return col not in rejected
+
+        start = time.perf_counter()
+        mat_lists = [[float(val) for val in row] for row in mat.tolist()]
+        old = [nearest_neighbour_day_lists(mat_lists, day, time_diff, can_visit=can_visit) for day in week]
+        old_time = time.perf_counter()-start
+
+        start = time.perf_counter()
+        consumed = np.zeros(n, dtype=bool)
+        new = [nearest_neighbour_day(mat, day, time_diff, can_visit=can_visit, consumed=consumed) for day in week]
+        new_time = time.perf_counter()-start
+
+        same = all(o[0] == [(c, float(t)) for c, t in s[0]] and o[1] == s[1] and o[2] == s[2] for o, s in zip(old, new))
+        print(f"n={n}: lists {old_time*1000:.1f} ms, numpy {new_time*1000:.1f} ms, same routes: {same}")
+
+
+# Random houses in a 30 x 30 minute square, for a day of time_diff seconds: the nearest house route next to the improved one
+def benchmark_improvement(sizes=(10, 20, 40), days=50, time_diff=8*60*60, seed=0):
+    rnd = random.Random(seed)
+    for n in sizes:
+        visits = [0, 0]
+        drive = [0, 0]
+        took = 0.0
+        for _ in range(days):
+            points = np.array([[rnd.random(), rnd.random()] for _ in range(n)])
+            mat = np.rint(np.sqrt(((points[:, None]-points[None, :])**2).sum(axis=2))*1800).astype(np.int32)
+            candidates = list(range(1, n))
+            stops, legs, left = nearest_neighbour_day(mat, candidates, time_diff)
+            start = time.perf_counter()
+            route = improve_route(mat, [col for col, start in stops], candidates, time_diff)
+            took += time.perf_counter()-start
+            for ind, visited in enumerate(([col for col, start in stops], route)):
+                visits[ind] += len(visited)
+                drive[ind] += sum(int(mat[a, b]) for a, b in zip([0]+visited, visited))
+        print(f"n={n}: nearest house {visits[0]} visits {drive[0]//60} min driving, improved {visits[1]} visits {drive[1]//60} min driving, "
+              f"{took/days*1000:.1f} ms per day")
+
+
+# Checks held_karp against brute force on random days: every order of every subset of the candidates (the prefixes of all the
+# permutations) is tried, and the best one (most visits that fit into the day, then least driving) has to have the same visits and
+# driving as the route of held_karp. Some candidates are not allowed by can_visit, and the days are short enough that not all fit
+def benchmark_held_karp(sizes=(3, 5, 7, 8), days=20, visit_time=20*60, seed=0):
+    rnd = random.Random(seed)
+    for k in sizes:
+        same = 0
+        took = 0.0
+        for _ in range(days):
+            points = np.array([[rnd.random(), rnd.random()] for _ in range(k+1)])
+            mat = np.rint(np.sqrt(((points[:, None]-points[None, :])**2).sum(axis=2))*1800).astype(np.int32)
+            time_diff = rnd.randint(1, 4)*60*60
+            rejected = set(rnd.sample(range(1, k+1), k//4))
+
+            def can_visit(col):
+                return col not in rejected
+
+            start = time.perf_counter()
+            route = held_karp(mat, list(range(1, k+1)), time_diff, visit_time, can_visit)
+            took += time.perf_counter()-start
+
+            best = (0, 0)
+            for order in itertools.permutations([col for col in range(1, k+1) if can_visit(col)]):
+                drive = 0
+                for m, col in enumerate(order):
+                    drive += int(mat[order[m-1] if m else 0, col])
+                    if drive+(m+1)*visit_time > time_diff:
+                        break
+                    best = min(best, (-(m+1), drive))
+            same += (-len(route), route_drive(mat, route)) == best and not set(route) & rejected
+        print(f"k={k}: held_karp {took/days*1000:.2f} ms per day, same as brute force on {same} of {days} days")
+
+
+if __name__ == '__main__':
+    benchmark_nearest_neighbour()
+    benchmark_improvement()
+    benchmark_held_karp()
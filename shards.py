@@ -0,0 +1,72 @@
+import math
+import random
+
+import numpy as np
+
+
+# (lat, lng) to km on a flat map around the middle of the points, good enough for a city or a region
+def to_plane(coords):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if not len(coords):
+        return coords
+    mid = math.radians(coords[:, 0].mean())
+    return np.column_stack([coords[:, 0]*111.32, coords[:, 1]*111.32*math.cos(mid)])
+
+
+# k-means on points (n x 2): the first centers are picked like in k-means++ (far away points are more likely), then the points
+# are given to the nearest center and the centers are moved to the middle of their points until nothing changes
+def kmeans(points, k: int, seed=0, iters=50):
+    rnd = random.Random(seed)
+    n = len(points)
+    k = max(1, min(k, n))
+    centers = [points[rnd.randrange(n)]]
+    for _ in range(1, k):
+        dist = ((points[:, None, :]-np.array(centers)[None, :, :])**2).sum(axis=2).min(axis=1)
+        if dist.sum() == 0:
+            break
+        centers.append(points[rnd.choices(range(n), weights=dist.tolist())[0]])
+    centers = np.array(centers)
+
+    labels = None
+    for _ in range(iters):
+        new_labels = ((points[:, None, :]-centers[None, :, :])**2).sum(axis=2).argmin(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        for c in range(len(centers)):
+            if (labels == c).any():
+                centers[c] = points[labels == c].mean(axis=0)
+    return centers, labels
+
+
+# The clinic cut into shards of about shard_size patients by where they live (k-means on the patients, every therapist goes to the
+# shard with the nearest center)
+#   patient_shard   the shard of every patient
+#   therapist_shard the shard of every therapist
+#   order           for every patient the shards from the nearest center to the farthest
+#   near            for every patient their own shard and the shards whose center is not more than boundary_km farther away than
+#                   their own one, these patients live at the border and can also be visited from there
+class Shards:
+
+    def __init__(self, t_coords, p_coords, shard_size=200, boundary_km=2.0, seed=0):
+        t_points = to_plane(t_coords)
+        p_points = to_plane(p_coords)
+        k = max(1, math.ceil(len(p_points)/shard_size)) if len(p_points) else 1
+        if len(p_points):
+            self.centers, self.patient_shard = kmeans(p_points, k, seed)
+        else:
+            self.centers, self.patient_shard = (t_points[:1] if len(t_points) else np.zeros((1, 2))), np.zeros(0, dtype=np.intp)
+
+        self.therapist_shard = np.sqrt(((t_points[:, None, :]-self.centers[None, :, :])**2).sum(axis=2)).argmin(axis=1)
+        dist = np.sqrt(((p_points[:, None, :]-self.centers[None, :, :])**2).sum(axis=2))
+        self.order = dist.argsort(axis=1, kind='stable').tolist()
+        own = dist.min(axis=1) if len(p_points) else dist[:, :0]
+        self.near = [[s for s in row if dist[p, s] <= own[p]+boundary_km] for p, row in enumerate(self.order)]
+
+    def __len__(self):
+        return len(self.centers)
+
+    def summary(self):
+        sizes = np.bincount(self.patient_shard, minlength=len(self)) if len(self.patient_shard) else np.zeros(len(self), dtype=int)
+        border = sum(1 for near in self.near if len(near) > 1)
+        return f"{len(self)} shards of {sizes.min()} to {sizes.max()} patients, {border} patients at a border"
@@ -0,0 +1,134 @@
+import math
+
+import numpy as np
+
+from geocode import estimate_matrix
+
+
+# A travel time matrix that only keeps the exact travel times it was given (in CSR arrays: the columns and seconds of row i are
+# indices[indptr[i]:indptr[i+1]] and data[indptr[i]:indptr[i+1]], the columns sorted), every other pair is guessed from the
+# positions of the addresses (coords, n x 2 lat/lng) with estimate_matrix. So it needs memory for the exact pairs only, not n x n
+# It can be read like the dense numpy matrix: mat[i, j] gives an int, mat[i, cols] and mat[np.ix_(rows, cols)] numpy arrays,
+# and written like it too (mat[rows, cols] = seconds, mat[np.ix_(rows, cols)] = block), which is how fill_exact fills it
+class SparseMatrix:
+
+    def __init__(self, coords, speed_kmh=40.0, road_factor=1.3):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.speed_kmh = speed_kmh
+        self.road_factor = road_factor
+        self.radians = np.radians(self.coords).tolist()
+        n = len(self.coords)
+        self.indptr = np.zeros(n+1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0, dtype=np.int32)
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def nbytes(self):
+        self.build()
+        return self.indptr.nbytes+self.indices.nbytes+self.data.nbytes+self.coords.nbytes
+
+    # number of exact travel times kept
+    @property
+    def nnz(self):
+        self.build()
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        rows, cols = key
+        rows, cols, value = np.broadcast_arrays(np.asarray(rows), np.asarray(cols), np.asarray(value))
+        self.pending.update(zip(zip(rows.ravel().tolist(), cols.ravel().tolist()), value.ravel().tolist()))
+
+    # The new values are put into the CSR arrays only when something is read, so that a lot of small writes stay cheap
+    def build(self):
+        if not self.pending:
+            return
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        old = dict(zip(zip(rows.tolist(), self.indices.tolist()), self.data.tolist()))
+        old.update(self.pending)
+        self.pending = {}
+
+        keys = np.array(list(old), dtype=np.int64).reshape(-1, 2)
+        vals = np.fromiter(old.values(), dtype=np.int32, count=len(old))
+        order = np.lexsort((keys[:, 1], keys[:, 0]))
+        keys = keys[order]
+        self.indices = keys[:, 1].astype(np.int32)
+        self.data = vals[order]
+        self.indptr = np.zeros(len(self)+1, dtype=np.int64)
+        np.cumsum(np.bincount(keys[:, 0], minlength=len(self)), out=self.indptr[1:])
+
+    def estimate(self, rows, cols):
+        return estimate_matrix(self.coords[rows], self.speed_kmh, self.road_factor, dests=self.coords[cols])
+
+    # row i at the columns cols: the guesses, with the exact values where there are any
+    def row(self, i: int, cols):
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        out = self.estimate([i], cols)[0]
+        out[cols == i] = 0
+        start, end = self.indptr[i], self.indptr[i+1]
+        if end > start and len(cols):
+            known = self.indices[start:end]
+            pos = np.minimum(np.searchsorted(known, cols), len(known)-1)
+            hit = known[pos] == cols
+            out[hit] = self.data[start+pos[hit]]
+        return out
+
+    # One travel time, without numpy arrays around it (the guess is the same formula as in estimate_matrix)
+    def get(self, i: int, j: int):
+        self.build()
+        if i == j:
+            return 0
+        start, end = self.indptr[i], self.indptr[i+1]
+        if end > start:
+            known = self.indices[start:end]
+            pos = int(known.searchsorted(j))
+            if pos < end-start and known[pos] == j:
+                return int(self.data[start+pos])
+        lat, lng = self.radians[i]
+        to_lat, to_lng = self.radians[j]
+        a = math.sin((lat-to_lat)/2)**2+math.cos(lat)*math.cos(to_lat)*math.sin((lng-to_lng)/2)**2
+        km = 2*6371.0*math.asin(math.sqrt(min(max(a, 0.0), 1.0)))
+        return int(round(km*self.road_factor/self.speed_kmh*3600))
+
+    def __getitem__(self, key):
+        self.build()
+        if not isinstance(key, tuple):
+            return SparseRow(self, int(key))
+        rows, cols = key
+        if np.ndim(rows) == 0 and np.ndim(cols) == 0:
+            return self.get(int(rows), int(cols))
+        if np.ndim(rows) == 0:
+            out = self.row(int(rows), cols)
+            return out[0] if np.ndim(cols) == 0 else out
+        rows = np.asarray(rows).reshape(-1)
+        return np.array([self.row(int(i), cols) for i in rows], dtype=np.int32).reshape(len(rows), -1)
+
+    # The same matrix for only the addresses inds (in this order, an address can be in it more than once), with the exact values between them
+    def sub(self, inds: list):
+        self.build()
+        inds = [int(i) for i in inds]
+        where = {}
+        for a, i in enumerate(inds):
+            where.setdefault(i, []).append(a)
+        part = SparseMatrix(self.coords[inds], self.speed_kmh, self.road_factor)
+        for a, i in enumerate(inds):
+            start, end = self.indptr[i], self.indptr[i+1]
+            for j, seconds in zip(self.indices[start:end].tolist(), self.data[start:end].tolist()):
+                for b in where.get(j, ()):
+                    part.pending[(a, b)] = seconds
+        part.build()
+        return part
+
+
+# mat[i] of a SparseMatrix, so that it can also be read like lists (mat[i][j])
+class SparseRow:
+
+    def __init__(self, mat: SparseMatrix, i: int):
+        self.mat = mat
+        self.i = i
+
+    def __getitem__(self, j):
+        return self.mat.get(self.i, j)
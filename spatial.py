@@ -0,0 +1,111 @@
+import math
+import random
+import time
+
+import numpy as np
+
+
+# A uniform grid over points (n x 2, in km, see shards.to_plane) to find the nearest points of a place without looking at all of them
+# The cells are cell_km wide, by default so that there are about two points in a cell. A query looks at the ring of cells around
+# the place, then the next ring and so on, until it has k points and no point in a farther ring can be nearer than them
+class GridIndex:
+
+    def __init__(self, points, cell_km=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        n = len(self.points)
+        if cell_km is None:
+            if n > 1:
+                span = self.points.max(axis=0)-self.points.min(axis=0)
+                cell_km = math.sqrt(max(span[0]*span[1], span.max()**2/n, 1e-6)*2/n)
+            else:
+                cell_km = 1.0
+        self.cell_km = max(cell_km, 1e-6)
+
+        self.cells = {}
+        for i, (x, y) in enumerate(self.points):
+            self.cells.setdefault(self.cell(x, y), []).append(i)
+        if self.cells:
+            keys = np.array(list(self.cells))
+            self.low = keys.min(axis=0)
+            self.high = keys.max(axis=0)
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, x, y):
+        return int(math.floor(x/self.cell_km)), int(math.floor(y/self.cell_km))
+
+    # The indexes of the k nearest points to (x, y), nearest first. skip is an index that is not given back (the place itself)
+    def nearest(self, x, y, k: int, skip=None):
+        if not self.cells or k <= 0:
+            return []
+        cx, cy = self.cell(x, y)
+        max_ring = int(max(abs(cx-self.low[0]), abs(cx-self.high[0]), abs(cy-self.low[1]), abs(cy-self.high[1])))
+        found = []
+        for ring in range(max_ring+1):
+            for gx in range(cx-ring, cx+ring+1):
+                for gy in ((cy-ring, cy+ring) if abs(gx-cx) != ring else range(cy-ring, cy+ring+1)):
+                    for i in self.cells.get((gx, gy), ()):
+                        if i != skip:
+                            px, py = self.points[i]
+                            found.append(((px-x)**2+(py-y)**2, i))
+            # every point that is not seen yet is at least ring cells away
+            if len(found) >= k:
+                found.sort()
+                if found[k-1][0] <= (ring*self.cell_km)**2:
+                    break
+        found.sort()
+        return [i for dist, i in found[:k]]
+
+
+# The pairs (i, j) with j < i of the points that are among the k nearest of each other (in one direction is enough)
+# Instead of the n*(n-1)/2 pairs of the whole matrix this is at most n*k
+def nearest_pairs(points, k: int):
+    index = GridIndex(points)
+    pairs = set()
+    for i, (x, y) in enumerate(index.points):
+        for j in index.nearest(x, y, k, skip=i):
+            pairs.add((max(i, j), min(i, j)))
+    return pairs
+
+
+# Checks GridIndex.nearest against brute force (the distances to all the points, sorted) for uniform points and for points in a
+# few tight clusters (many empty cells and many points in one cell), with queries at the points themselves and anywhere around them.
+# Points can be equally far, so the distances of the k found are compared, not the indexes. Then nearest_pairs is checked the same way
+def benchmark_grid(sizes=(50, 500, 2000), k=8, queries=200, seed=0):
+    rnd = random.Random(seed)
+    for n in sizes:
+        for kind in ('uniform', 'clustered'):
+            if kind == 'uniform':
+                points = np.array([[rnd.uniform(0, 30), rnd.uniform(0, 30)] for _ in range(n)])
+            else:
+                centers = [(rnd.uniform(0, 30), rnd.uniform(0, 30)) for _ in range(4)]
+                points = np.array([[cx+rnd.gauss(0, 0.3), cy+rnd.gauss(0, 0.3)] for cx, cy in (rnd.choice(centers) for _ in range(n))])
+            index = GridIndex(points)
+
+            same = 0
+            took = 0.0
+            for q in range(queries):
+                skip = rnd.randrange(n) if q % 2 else None
+                x, y = points[skip] if skip is not None else (rnd.uniform(-5, 35), rnd.uniform(-5, 35))
+                start = time.perf_counter()
+                found = index.nearest(x, y, k, skip=skip)
+                took += time.perf_counter()-start
+                dist = ((points[:, 0]-x)**2+(points[:, 1]-y)**2).tolist()
+                brute = sorted(dist[i] for i in range(n) if i != skip)[:k]
+                same += [dist[i] for i in found] == brute
+
+            # a pair has to be among the k nearest of one of its two points, and every point nearer than the k-th of a point has to
+            # be paired with it (the k-th itself can be one of several equally far points)
+            pairs = nearest_pairs(points, k)
+            dist = ((points[:, None]-points[None, :])**2).sum(axis=2)
+            np.fill_diagonal(dist, np.inf)
+            kth = np.sort(dist, axis=1)[:, min(k, n-1)-1]
+            agrees = all(dist[i, j] <= kth[i] or dist[i, j] <= kth[j] for i, j in pairs)
+            agrees &= all((max(i, j), min(i, j)) in pairs for i, j in zip(*np.nonzero(dist < kth[:, None])))
+            print(f"n={n} {kind}: {took/queries*1000:.3f} ms per query, same as brute force on {same} of {queries} queries, "
+                  f"nearest_pairs {'agrees' if agrees else 'differs'}")
+
+
+if __name__ == '__main__':
+    benchmark_grid()
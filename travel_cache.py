@@ -0,0 +1,127 @@
+import hashlib
+import sqlite3
+import time
+
+
+# Addresses are typed by hand in the GUI, so the same house can show up as "12 Main St, Town" and
+# "12  main st,town". Both should hit the same cache entry, so the key is built from a normalized form
+def normalize_address(addr: str):
+    addr = addr.replace('|', ' ').replace('\n', ' ').lower()
+    addr = ', '.join(part.strip() for part in addr.split(','))
+    return ' '.join(addr.split())
+
+
+def pair_key(origin: str, dest: str):
+    key = normalize_address(origin)+'\x00'+normalize_address(dest)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# This class keeps the travel times that were already fetched from the distance api on the local disk,
+# so that the next run of find_schedule only has to ask the api for the pairs it has never seen (or which are too old)
+# ttl is in seconds (None means the values never expire) and max_entries is the size limit, when the cache
+# grows above it the least recently used pairs are thrown out
+class TravelTimeCache:
+
+    placeholder = '?'
+    create_query = """CREATE TABLE IF NOT EXISTS travel_time_cache (
+                        pair_key CHAR(40) PRIMARY KEY,
+                        seconds INTEGER NOT NULL,
+                        created DOUBLE NOT NULL,
+                        last_used DOUBLE NOT NULL)"""
+
+    def __init__(self, path="travel_cache.db", ttl=7*24*60*60, max_entries=200000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db = self.connect(path)
+        curs = self.db.cursor()
+        curs.execute(self.create_query)
+        curs.execute("CREATE INDEX IF NOT EXISTS travel_time_cache_lru ON travel_time_cache (last_used)")
+        self.db.commit()
+
+    def connect(self, path):
+        return sqlite3.connect(path)
+
+    def close(self):
+        self.db.close()
+
+    def _in_list(self, n):
+        return ','.join([self.placeholder]*n)
+
+    # Returns {(origin, dest): seconds} for every pair that is in the cache and is not expired
+    def get_many(self, pairs):
+        keys = {}
+        for origin, dest in pairs:
+            keys[pair_key(origin, dest)] = (origin, dest)
+
+        now = time.time()
+        found = {}
+        curs = self.db.cursor()
+        key_list = list(keys)
+        # sqlite has a limit on the number of parameters in one query, so the keys are sent in chunks
+        for s in range(0, len(key_list), 500):
+            chunk = key_list[s:s+500]
+            curs.execute(f"SELECT pair_key, seconds, created FROM travel_time_cache WHERE pair_key IN ({self._in_list(len(chunk))})", chunk)
+            for key, seconds, created in curs.fetchall():
+                if self.ttl is None or now-created <= self.ttl:
+                    found[key] = seconds
+
+        if found:
+            query = f"UPDATE travel_time_cache SET last_used = {self.placeholder} WHERE pair_key = {self.placeholder}"
+            curs.executemany(query, [(now, key) for key in found])
+            self.db.commit()
+
+        return {keys[key]: seconds for key, seconds in found.items()}
+
+    # values is a dictionary of {(origin, dest): seconds}
+    def put_many(self, values: dict):
+        if not values:
+            return
+        now = time.time()
+        rows = {}
+        for (origin, dest), seconds in values.items():
+            rows[pair_key(origin, dest)] = (int(seconds), now, now)
+        query = f"REPLACE INTO travel_time_cache (pair_key, seconds, created, last_used) VALUES ({self._in_list(4)})"
+        curs = self.db.cursor()
+        curs.executemany(query, [(key,)+row for key, row in rows.items()])
+        self.db.commit()
+        self.evict()
+
+    # First the expired pairs are removed and then, if the cache is still too big, the least recently used ones
+    def evict(self):
+        curs = self.db.cursor()
+        if self.ttl is not None:
+            curs.execute(f"DELETE FROM travel_time_cache WHERE created < {self.placeholder}", (time.time()-self.ttl,))
+
+        if self.max_entries is not None:
+            curs.execute("SELECT COUNT(*) FROM travel_time_cache")
+            extra = curs.fetchall()[0][0]-self.max_entries
+            if extra > 0:
+                curs.execute(f"SELECT pair_key FROM travel_time_cache ORDER BY last_used LIMIT {int(extra)}")
+                old_keys = curs.fetchall()
+                curs.executemany(f"DELETE FROM travel_time_cache WHERE pair_key = {self.placeholder}", old_keys)
+        self.db.commit()
+
+
+# Same cache, but kept in a table of the scheduler's own mysql database instead of a file
+# db is an already opened mysql.connector connection
+class MySQLTravelTimeCache(TravelTimeCache):
+
+    placeholder = '%s'
+    create_query = """CREATE TABLE IF NOT EXISTS travel_time_cache (
+                        pair_key CHAR(40) PRIMARY KEY,
+                        seconds INT NOT NULL,
+                        created DOUBLE NOT NULL,
+                        last_used DOUBLE NOT NULL,
+                        INDEX travel_time_cache_lru (last_used))"""
+
+    def __init__(self, db, ttl=7*24*60*60, max_entries=200000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db = db
+        curs = self.db.cursor()
+        curs.execute(self.create_query)
+        self.db.commit()
+
+    # The connection belongs to find_schedule, so it is not closed here
+    def close(self):
+        pass
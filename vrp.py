@@ -0,0 +1,277 @@
+import heapq
+import random
+
+from routing import two_opt, or_opt
+
+
+# The cheapest place to put x into the path (the home first, then the stops) and how much more driving it is, as (cost, position
+# in the stops). Also used on its own to repair a stored schedule (see repair in algo_v2)
+def cheapest_insertion(d, path: list, x: int):
+    best = None
+    for j in range(1, len(path)+1):
+        a = path[j-1]
+        cost = d[a][x] if j == len(path) else d[a][x]+d[x][path[j]]-d[a][path[j]]
+        if best is None or cost < best[0]:
+            best = (cost, j-1)
+    return best
+
+
+# One day of one therapist in the clinic wide solver
+# key is (therapist id, day), home is the therapist's place in the matrix, length the seconds between time_from and time_to,
+# job the therapist's profession and candidates the patients who can get a visit from this therapist on this day
+class Route:
+
+    def __init__(self, key, home: int, length, job, candidates: list):
+        self.key = key
+        self.home = home
+        self.length = length
+        self.job = job
+        self.candidates = candidates
+        self.stops = []
+        self.duration = 0
+        self.version = 0
+
+
+# The whole clinic at once: every therapist-day is a route and a patient can go into any route they are a candidate of
+# (the right profession on a day they are available), as long as they get at most one visit a day, week_limit visits a week,
+# profession_limit visits a week from the same profession and at most one visit a week from the same therapist, and the route (driving plus visits) still fits into the therapist's day.
+# This is a vehicle routing problem with time windows (the therapists' hours), it is solved with
+#   construction: the cheapest insertion of all the patients into all the routes, patients with fewer visits go first
+#   large neighbourhood search: some of the visits are taken out (random ones or the ones that cost the most driving), put back in
+#   with the same insertion, the changed routes are made shorter with 2-opt and or-opt, and the new schedule is kept if it is not
+#   worse (more patients with a visit, then more visits, then less driving). This goes on for about lns_seconds, counted in steps of
+#   work (see search) and not on the clock, so the same input and seed always give the same schedule
+# d is the travel time matrix as lists and nodes gives the place of every patient in it
+# fixed are the visits the patients already have in routes that are not solved here, as {pid: [(t_id, day, job), ...]}, they count
+# towards the limits (see reschedule in algo_v2)
+class ClinicSolver:
+
+    # about how many steps of work (see search) are done in a second, lns_seconds is turned into steps with it
+    work_per_second = 500000
+
+    def __init__(self, d: list, routes: list, nodes: dict, visit_time=90*60, week_limit=3, profession_limit=2, seed=0, fixed=None):
+        self.d = d
+        self.fixed = fixed if fixed is not None else {}
+        self.routes = routes
+        self.nodes = nodes
+        self.visit_time = visit_time
+        self.week_limit = week_limit
+        self.profession_limit = profession_limit
+        self.rnd = random.Random(seed)
+
+        # the routes every patient can go into, in the order of the routes
+        self.options = {}
+        for r, route in enumerate(routes):
+            for pid in route.candidates:
+                self.options.setdefault(pid, []).append(r)
+
+        self.visits = {pid: [] for pid in self.options}     # pid -> indexes of the routes visiting them
+        self.cheapest = {}                                   # (pid, r) -> (route version, cost, position)
+        self.work = 0                                        # steps of insertion and shorten done so far (see search)
+
+    def solve(self, lns_seconds=1.0):
+        self.construct()
+        for route in self.routes:
+            self.shorten(route)
+        self.search(lns_seconds)
+        return self.routes
+
+    # Whether pid may get one more visit from the route, only the patient's limits are checked here, not the time
+    def allowed(self, pid, r: int):
+        route = self.routes[r]
+        visits = self.visits[pid]
+        fixed = self.fixed.get(pid, ())
+        if len(visits)+len(fixed) >= self.week_limit or r in visits:
+            return False
+        t_id, day = route.key
+        same_job = 0
+        for v_t_id, v_day, v_job in [self.routes[v].key+(self.routes[v].job,) for v in visits]+list(fixed):
+            if v_day == day or v_t_id == t_id:
+                return False
+            if v_job == route.job:
+                same_job += 1
+        return same_job < self.profession_limit
+
+    # The cheapest place to put pid in the route and how much longer the day gets, None if it does not fit
+    def insertion(self, pid, r: int):
+        route = self.routes[r]
+        cached = self.cheapest.get((pid, r))
+        if cached is not None and cached[0] == route.version:
+            return cached[1:]
+
+        path = [route.home]+[self.nodes[p] for p in route.stops]
+        best = cheapest_insertion(self.d, path, self.nodes[pid])
+        self.work += len(path)
+        if route.duration+best[0]+self.visit_time > route.length:
+            best = None
+
+        self.cheapest[(pid, r)] = (route.version,)+(best if best is not None else (None, None))
+        return best if best is not None else (None, None)
+
+    def insert(self, pid, r: int, pos: int, cost):
+        route = self.routes[r]
+        route.stops.insert(pos, pid)
+        route.duration += cost+self.visit_time
+        route.version += 1
+        self.visits[pid].append(r)
+
+    def remove(self, pid, r: int):
+        route = self.routes[r]
+        route.stops.remove(pid)
+        route.duration = self.duration(route)
+        route.version += 1
+        self.visits[pid].remove(r)
+
+    def duration(self, route: Route):
+        path = [route.home]+[self.nodes[p] for p in route.stops]
+        return sum(self.d[a][b] for a, b in zip(path, path[1:]))+self.visit_time*len(route.stops)
+
+    # The cheapest route (and place in it) pid can still go into as (cost, route, position), the first route if some cost the same
+    def best_option(self, pid):
+        best = None
+        for r in self.options[pid]:
+            self.work += 1
+            if not self.allowed(pid, r):
+                continue
+            cost, pos = self.insertion(pid, r)
+            if cost is not None and (best is None or cost < best[0]):
+                best = (cost, r, pos)
+        return best
+
+    # Puts visits in as long as any fits, each time the one of the patient with the fewest visits that adds the least driving
+    # (the first patient if some are the same). The best option of every patient is kept in a heap, after a visit is put into a
+    # route only the patient and the other candidates of that route are looked at again, not every patient and route
+    def construct(self):
+        order = {pid: i for i, pid in enumerate(self.options)}
+        best = {}
+        stamp = {}
+        heap = []
+
+        def push(pid, found):
+            best[pid] = found
+            stamp[pid] = stamp.get(pid, 0)+1
+            if found is not None:
+                had = len(self.visits[pid])+len(self.fixed.get(pid, ()))
+                heapq.heappush(heap, (had, found[0], order[pid], stamp[pid], pid))
+
+        def full(pid):
+            had = len(self.visits[pid])+len(self.fixed.get(pid, ()))
+            push(pid, self.best_option(pid) if had < self.week_limit else None)
+
+        for pid in self.options:
+            full(pid)
+
+        while heap:
+            had, cost, i, pid_stamp, pid = heapq.heappop(heap)
+            if pid_stamp != stamp[pid]:
+                continue
+            cost, r, pos = best[pid]
+            self.insert(pid, r, pos, cost)
+            full(pid)
+
+            # only route r changed, for the other candidates of it only that option has to be looked at again
+            for other in dict.fromkeys(self.routes[r].candidates):
+                if other == pid or best[other] is None and len(self.visits[other])+len(self.fixed.get(other, ())) >= self.week_limit:
+                    continue
+                if best[other] is not None and best[other][1] == r:
+                    full(other)
+                    continue
+                self.work += 1
+                if not self.allowed(other, r):
+                    continue
+                new_cost, new_pos = self.insertion(other, r)
+                if new_cost is not None and (best[other] is None or (new_cost, r) < best[other][:2]):
+                    push(other, (new_cost, r, new_pos))
+
+    # 2-opt and or-opt on one route (see routing.py), the time won is used by the next insertions
+    def shorten(self, route: Route):
+        if len(route.stops) < 2:
+            return
+        nodes = [route.home]+[self.nodes[p] for p in route.stops]
+        d = [[self.d[a][b] for b in nodes] for a in nodes]
+        path = list(range(len(nodes)))
+        while two_opt(d, path) or or_opt(d, path):
+            self.work += len(nodes)**2
+        self.work += len(nodes)**2
+        stops = [route.stops[p-1] for p in path[1:]]
+        if stops != route.stops:
+            route.stops = stops
+            route.duration = self.duration(route)
+            route.version += 1
+
+    def score(self):
+        served = sum(1 for visits in self.visits.values() if visits)
+        visits = sum(len(visits) for visits in self.visits.values())
+        drive = sum(route.duration for route in self.routes)-visits*self.visit_time
+        return served, visits, -drive
+
+    def snapshot(self):
+        return [list(route.stops) for route in self.routes]
+
+    def restore(self, stops: list):
+        for pid in self.visits:
+            self.visits[pid] = []
+        for r, route in enumerate(self.routes):
+            if route.stops != stops[r]:
+                route.stops = list(stops[r])
+                route.duration = self.duration(route)
+                route.version += 1
+            for pid in route.stops:
+                self.visits[pid].append(r)
+
+    # Takes out count visits, either random ones or the ones whose removal saves the most driving
+    def destroy(self, count: int):
+        placed = [(pid, r) for r, route in enumerate(self.routes) for pid in route.stops]
+        if self.rnd.random() < 0.5:
+            removed = self.rnd.sample(placed, min(count, len(placed)))
+        else:
+            saving = []
+            for pid, r in placed:
+                route = self.routes[r]
+                path = [route.home]+[self.nodes[p] for p in route.stops]
+                i = route.stops.index(pid)+1
+                a, x = path[i-1], path[i]
+                save = self.d[a][x]
+                if i+1 < len(path):
+                    save += self.d[x][path[i+1]]-self.d[a][path[i+1]]
+                saving.append((save+self.rnd.random(), pid, r))
+            saving.sort(reverse=True)
+            removed = [(pid, r) for save, pid, r in saving[:count]]
+
+        for pid, r in removed:
+            self.remove(pid, r)
+        return set(r for pid, r in removed)
+
+    # The search stops after lns_seconds*work_per_second steps of work (every route looked at in construct, every place tried by
+    # cheapest_insertion and every 2-opt/or-opt pass), which only depends on the input and the seed, not on the clock
+    def search(self, lns_seconds):
+        budget = self.work+lns_seconds*self.work_per_second
+        best_score = self.score()
+        best = self.snapshot()
+        placed = sum(len(route.stops) for route in self.routes)
+        if placed == 0:
+            return
+
+        while self.work < budget:
+            count = self.rnd.randint(1, max(2, placed//5))
+            changed = self.destroy(count)
+            self.construct()
+            for r in changed:
+                self.shorten(self.routes[r])
+            self.construct()
+
+            score = self.score()
+            if score >= best_score:
+                best_score = score
+                best = self.snapshot()
+                placed = score[1]
+            else:
+                self.restore(best)
+
+
+# Solves one part of the clinic on its own (one shard, see plan_clinic in algo_v2), it can run in another process
+# d only has to cover the homes and candidates of these routes. Gives back the stops of every route
+def solve_part(d: list, routes: list, nodes: dict, visit_time=90*60, week_limit=3, profession_limit=2, lns_seconds=1.0, seed=0):
+    clinic = ClinicSolver(d, routes, nodes, visit_time, week_limit, profession_limit, seed)
+    clinic.solve(lns_seconds)
+    return [route.stops for route in routes]